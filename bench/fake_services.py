@@ -0,0 +1,199 @@
+import json
+import random
+import threading
+import time
+import hashlib
+import http.server
+
+from urllib.parse import urlparse, parse_qs
+from xml.sax.saxutils import escape
+
+
+TOPICS = {
+    "python": ["python", "язык", "программирование", "функция", "модуль", "интерпретатор", "библиотека"],
+    "борщ": ["борщ", "свёкла", "капуста", "бульон", "рецепт", "кастрюля", "сметана"],
+    "apple": ["apple", "iphone", "компания", "стив", "джобс", "смартфон", "акции"],
+    "космос": ["космос", "ракета", "орбита", "спутник", "гагарин", "станция", "полёт"],
+    "футбол": ["футбол", "матч", "команда", "гол", "чемпионат", "тренер", "стадион"],
+}
+FILLER = ["и", "в", "на", "что", "это", "также", "который", "может", "быть", "очень", "для", "при", "если", "когда"]
+
+
+def _seed(*parts) -> int:
+    return int.from_bytes(hashlib.blake2b("\0".join(map(str, parts)).encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def make_page(page_id: int, paragraphs: int = 20) -> str:
+    """
+    Deterministic HTML page about one of the TOPICS, with navigation, a cookie banner and a footer
+    around the article so that content extraction has real work to do.
+    """
+
+    rng = random.Random(_seed("page", page_id))
+    topic = list(TOPICS)[page_id % len(TOPICS)]
+    words = TOPICS[topic]
+    body = []
+    for i in range(paragraphs):
+        sentence = " ".join(rng.choice(words if rng.random() < 0.4 else FILLER) for _ in range(rng.randint(40, 90)))
+        if i % 6 == 0:
+            body.append(f"<h2>{topic.capitalize()}: раздел {i // 6 + 1}</h2>")
+        body.append(f"<p>{sentence.capitalize()}.</p>")
+    links = "".join(f'<li><a href="/page/{rng.randint(0, 10_000)}">Ссылка {i}</a></li>' for i in range(15))
+    return (
+        "<!DOCTYPE html><html><head><meta charset='utf-8'>"
+        f"<title>{topic} #{page_id}</title><script>var tracking = {page_id};</script></head><body>"
+        f"<nav><ul>{links}</ul></nav>"
+        "<div class='cookie-banner'>Мы используем cookies. <button>OK</button></div>"
+        f"<article><h1>{topic.capitalize()} — статья {page_id}</h1>{''.join(body)}</article>"
+        "<footer>© Benchmark corpus</footer></body></html>"
+    )
+
+
+class _Server:
+    def __init__(self, handler, host: str = "127.0.0.1", port: int = 0):
+        self.httpd = http.server.ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class _QuietHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status: int, body: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class CorpusServer:
+    """
+    Static HTML corpus served on several loopback addresses (127.0.0.1, 127.0.0.2, ...),
+    so the fetcher's per-host limits behave as they do with real sites.
+
+    :param pages: Number of pages in the corpus; page N is served at /page/N.
+    :param hosts: Number of loopback addresses to serve on (Linux routes all of 127.0.0.0/8 to lo).
+    :param latency: Delay in seconds before every response.
+    :param jitter: Extra uniformly distributed delay in seconds.
+    :param error_rate: Share of pages that answer with HTTP 500.
+    """
+
+    def __init__(self, pages: int = 2000, hosts: int = 8, latency: float = 0.1, jitter: float = 0.1,
+                 error_rate: float = 0.05):
+        self.pages = pages
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        corpus = self
+
+        class Handler(_QuietHandler):
+            def do_GET(self):
+                time.sleep(corpus.latency + random.random() * corpus.jitter)
+                parts = self.path.strip("/").split("/")
+                if len(parts) != 2 or parts[0] != "page" or not parts[1].isdigit():
+                    return self._send(404, b"not found", "text/plain")
+                page_id = int(parts[1])
+                if random.Random(_seed("error", page_id)).random() < corpus.error_rate:
+                    return self._send(500, b"error", "text/plain")
+                self._send(200, make_page(page_id).encode("utf-8"), "text/html; charset=utf-8")
+
+        self._servers = [_Server(Handler, host=f"127.0.0.{i + 1}") for i in range(hosts)]
+
+    def start(self):
+        for server in self._servers:
+            server.start()
+        return self
+
+    def stop(self):
+        for server in self._servers:
+            server.stop()
+
+    def urls_for(self, query: str, count: int, engine: str) -> list[str]:
+        """URLs of the pages a fake engine returns for a query; engines overlap in about half of them."""
+        rng = random.Random(_seed(query))
+        shared = [rng.randrange(self.pages) for _ in range(count)]
+        own = random.Random(_seed(query, engine))
+        page_ids = [page_id if own.random() < 0.5 else own.randrange(self.pages) for page_id in shared]
+        return [f"{self._servers[page_id % len(self._servers)].base_url}/page/{page_id}" for page_id in page_ids]
+
+
+class SearchServer:
+    """
+    Fake search API answering in the Yandex XML (/yandex) and Google Custom Search JSON (/google) formats
+    with URLs of a CorpusServer.
+
+    :param corpus: The corpus the results point to.
+    :param latency: Delay in seconds before every response.
+    """
+
+    def __init__(self, corpus: CorpusServer, latency: float = 0.3):
+        self.corpus = corpus
+        self.latency = latency
+        self.requests = 0
+        search = self
+
+        class Handler(_QuietHandler):
+            def do_GET(self):
+                search.requests += 1
+                time.sleep(search.latency)
+                url = urlparse(self.path)
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                if url.path == "/yandex":
+                    groups = params.get("groupby", "").rsplit("=", 1)[-1]
+                    count = int(groups) if groups.isdigit() else 10
+                    body = search.yandex_response(params.get("query", ""), count)
+                    return self._send(200, body.encode("utf-8"), "application/xml; charset=utf-8")
+                if url.path == "/google":
+                    body = search.google_response(params.get("q", ""), int(params.get("num", 10)))
+                    return self._send(200, body.encode("utf-8"), "application/json; charset=utf-8")
+                self._send(404, b"not found", "text/plain")
+
+        self._server = _Server(Handler)
+
+    @property
+    def yandex_url(self) -> str:
+        return self._server.base_url + "/yandex"
+
+    @property
+    def google_url(self) -> str:
+        return self._server.base_url + "/google"
+
+    def yandex_response(self, query: str, count: int) -> str:
+        docs = "".join(
+            f"<group><doc><url>{escape(url)}</url><domain>{escape(urlparse(url).netloc)}</domain>"
+            f"<properties><extended-text>Результат по запросу {escape(query)}</extended-text></properties></doc></group>"
+            for url in self.corpus.urls_for(query, count, "yandex")
+        )
+        return (
+            '<?xml version="1.0" encoding="utf-8"?><yandexsearch version="1.0"><response>'
+            f"<results><grouping>{docs}</grouping></results></response></yandexsearch>"
+        )
+
+    def google_response(self, query: str, count: int) -> str:
+        items = [{"link": url, "snippet": f"Результат по запросу {query}"}
+                 for url in self.corpus.urls_for(query, count, "google")]
+        return json.dumps({"items": items}, ensure_ascii=False)
+
+    def start(self):
+        self._server.start()
+        return self
+
+    def stop(self):
+        self._server.stop()
@@ -0,0 +1,196 @@
+"""
+Offline benchmark of the full pipeline.
+
+Search engines, web pages and the LLM are replaced by local fakes (see fake_services.py and stub_llm.py),
+so runs need no credentials and are repeatable; the cross-encoder and the bi-encoder are the real models.
+Reports per-stage p50/p95 latency, throughput for each concurrency level and peak RSS, and saves the
+results as JSON so two runs can be compared:
+
+    python bench/run_bench.py --concurrency 1,4,8 --queries 16
+    python bench/run_bench.py --compare bench/results/<earlier run>.json
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import resource
+import tempfile
+import subprocess
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), "src")
+sys.path[:0] = [BENCH_DIR, SRC_DIR]
+
+from fake_services import CorpusServer, SearchServer
+
+QUERIES = [
+    "как изучать python", "python для анализа данных", "что такое модуль python",
+    "как приготовить борщ", "рецепт борща со сметаной", "сколько варить свёклу для борща",
+    "история компании apple", "акции apple сегодня", "первый iphone",
+    "первый полёт в космос", "как устроена орбитальная станция", "зачем нужны спутники",
+    "правила футбола", "чемпионат мира по футболу", "как выбрать футбольную команду",
+]
+
+
+def configure_environment(search: SearchServer, workdir: str, args):
+    """Points the search engines at the fake server and turns off the caches that would hide the work."""
+    for name in ("api_key.yaml", "api_key_google.yaml"):
+        with open(os.path.join(workdir, name), "w") as f:
+            f.write("folder_id: bench\ncse_id: bench\nsecret: bench\n")
+    os.environ.update({
+        "YANDEX_SEARCH_URL": search.yandex_url,
+        "GOOGLE_SEARCH_URL": search.google_url,
+        "YANDEX_CONFIG_PATH": os.path.join(workdir, "api_key.yaml"),
+        "GOOGLE_CONFIG_PATH": os.path.join(workdir, "api_key_google.yaml"),
+        "AIDS_CACHE_DIR": workdir,
+        "SEARCH_CACHE_SIZE": "0",
+    })
+    if not args.page_cache:
+        os.environ["PAGE_CACHE_PATH"] = ""
+
+
+def percentiles(values: list[float]) -> dict:
+    if not values:
+        return {"p50": None, "p95": None, "n": 0}
+    return {"p50": float(np.percentile(values, 50)), "p95": float(np.percentile(values, 95)), "n": len(values)}
+
+
+async def run_level(pipeline, queries: list[str], concurrency: int) -> dict:
+    slots = asyncio.Semaphore(concurrency)
+    timings = []
+    errors = []
+    over_budget = {}
+
+    async def one(query):
+        async with slots:
+            try:
+                result = await pipeline.run(query)
+            except Exception as e:
+                errors.append(f"{query}: {e!r}")
+                return
+            timings.append(dict(result.timings, total=result.elapsed()))
+            for stage in result.over_budget:
+                over_budget[stage] = over_budget.get(stage, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(query) for query in queries))
+    wall = time.perf_counter() - start
+
+    stages = sorted({stage for run in timings for stage in run})
+    return {
+        "concurrency": concurrency,
+        "queries": len(queries),
+        "errors": errors,
+        "wall_seconds": wall,
+        "throughput_qps": len(timings) / wall if wall else 0.0,
+        "over_budget": over_budget,
+        # Stages overlap, so each value is the time from the start of the query to the end of the stage
+        "stages": {stage: percentiles([run[stage] for run in timings if stage in run]) for stage in stages},
+    }
+
+
+def peak_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / 1024 ** 2 if sys.platform == "darwin" else rss / 1024
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def print_report(report: dict):
+    print(f"revision {report['revision']}, peak RSS {report['peak_rss_mb']:.0f} MB")
+    for level in report["levels"]:
+        print(f"\nconcurrency {level['concurrency']}: {level['throughput_qps']:.2f} queries/s, "
+              f"{len(level['errors'])} errors, {level['wall_seconds']:.1f}s wall")
+        for stage, stats in sorted(level["stages"].items(), key=lambda item: item[1]["p50"] or 0):
+            print(f"  {stage:<16} p50 {stats['p50']:7.3f}s   p95 {stats['p95']:7.3f}s")
+
+
+def print_comparison(report: dict, baseline: dict):
+    print(f"\ncompared with {baseline['revision']} ({baseline['started']}):")
+    base_levels = {level["concurrency"]: level for level in baseline["levels"]}
+    for level in report["levels"]:
+        base = base_levels.get(level["concurrency"])
+        if base is None:
+            continue
+        print(f"  concurrency {level['concurrency']}: throughput {base['throughput_qps']:.2f} -> {level['throughput_qps']:.2f} q/s")
+        for stage, stats in level["stages"].items():
+            old = base["stages"].get(stage)
+            if old and old["p50"] and stats["p50"]:
+                print(f"    {stage:<16} p50 {old['p50']:7.3f} -> {stats['p50']:7.3f}s ({stats['p50'] / old['p50'] - 1:+.0%})"
+                      f"   p95 {old['p95']:7.3f} -> {stats['p95']:7.3f}s")
+    print(f"  peak RSS {baseline['peak_rss_mb']:.0f} -> {report['peak_rss_mb']:.0f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", type=int, default=len(QUERIES), help="queries per concurrency level")
+    parser.add_argument("--concurrency", default="1,4", help="comma-separated concurrency levels")
+    parser.add_argument("--pages", type=int, default=2000, help="size of the HTML corpus")
+    parser.add_argument("--hosts", type=int, default=8, help="loopback addresses serving the corpus")
+    parser.add_argument("--page-latency", type=float, default=0.1, help="seconds before every page response")
+    parser.add_argument("--page-jitter", type=float, default=0.2, help="extra random page delay in seconds")
+    parser.add_argument("--search-latency", type=float, default=0.3, help="seconds before every search response")
+    parser.add_argument("--first-token", type=float, default=0.5, help="stub LLM time to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=40.0, help="stub LLM token rate")
+    parser.add_argument("--page-cache", action="store_true", help="keep the on-disk page cache enabled")
+    parser.add_argument("--out", help="where to save the JSON results (default: bench/results/<time>.json)")
+    parser.add_argument("--compare", help="earlier results JSON to compare with")
+    args = parser.parse_args()
+
+    corpus = CorpusServer(pages=args.pages, hosts=args.hosts, latency=args.page_latency, jitter=args.page_jitter).start()
+    search = SearchServer(corpus, latency=args.search_latency).start()
+    workdir = tempfile.mkdtemp(prefix="aids-bench-")
+    configure_environment(search, workdir, args)
+
+    # Imported only now: these modules read the environment at import time
+    import models
+    from stub_llm import StubLLM
+    from fetcher import run_sync
+    from pipeline import RetrievalPipeline
+
+    models.registry.set("llm", StubLLM(first_token_latency=args.first_token, tokens_per_second=args.tokens_per_second))
+    models.warmup(["cross_encoder", "bi_encoder"], background=False)
+    pipeline = RetrievalPipeline(answer_cache=None)
+
+    report = {
+        "started": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "revision": git_revision(),
+        "config": vars(args),
+        "levels": [],
+    }
+    for level, concurrency in enumerate(int(c) for c in args.concurrency.split(",")):
+        # Different queries on every level, so results of one level are not cached for the next
+        queries = [f"{QUERIES[i % len(QUERIES)]} {level * args.queries + i}" for i in range(args.queries)]
+        report["levels"].append(run_sync(run_level(pipeline, queries, concurrency)))
+    report["peak_rss_mb"] = peak_rss_mb()
+    report["search_requests"] = search.requests
+
+    search.stop()
+    corpus.stop()
+
+    out = args.out or os.path.join(BENCH_DIR, "results", time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+    print_report(report)
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(report, json.load(f))
+    print(f"\nsaved to {out}")
+
+
+if __name__ == "__main__":
+    main()
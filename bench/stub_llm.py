@@ -0,0 +1,53 @@
+import re
+import time
+
+from typing import Any, Iterator
+
+from langchain_core.language_models.llms import LLM
+from langchain_core.outputs import GenerationChunk
+
+
+class StubLLM(LLM):
+    """
+    Stand-in for GigaChat with a fixed time to first token and token rate.
+
+    Paraphrase prompts get a numbered list built from the user's query; every other prompt
+    gets an answer of ``answer_tokens`` words that cites the first sources.
+    """
+
+    first_token_latency: float = 0.5
+    tokens_per_second: float = 40.0
+    answer_tokens: int = 200
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub"
+
+    def _last_human_message(self, prompt: str) -> str:
+        messages = re.findall(r"^Human: (.*)$", prompt, flags=re.MULTILINE)
+        return messages[-1].strip().strip('"') if messages else prompt[-200:]
+
+    def _reply(self, prompt: str) -> list[str]:
+        query = self._last_human_message(prompt)
+        if "уточняющих версий" in prompt:
+            aspects = ["определение", "история", "примеры", "новости", "советы"]
+            return [f"{i + 1}. {query} {aspect}\n" for i, aspect in enumerate(aspects)]
+        if "перефразировку" in prompt:
+            return [f"1. {query} подробно"]
+        sources = sorted(set(re.findall(r"^\[(\d+)\]", prompt, flags=re.MULTILINE)), key=int)[:3] or ["1"]
+        return [f"слово{i} " + (f"[{sources[i % len(sources)]}] " if i % 25 == 24 else "")
+                for i in range(self.answer_tokens)]
+
+    def _call(self, prompt: str, stop: list[str] | None = None, run_manager=None, **kwargs: Any) -> str:
+        tokens = self._reply(prompt)
+        time.sleep(self.first_token_latency + len(tokens) / self.tokens_per_second)
+        return "".join(tokens)
+
+    def _stream(self, prompt: str, stop: list[str] | None = None, run_manager=None, **kwargs: Any) -> Iterator[GenerationChunk]:
+        time.sleep(self.first_token_latency)
+        for token in self._reply(prompt):
+            time.sleep(1 / self.tokens_per_second)
+            chunk = GenerationChunk(text=token)
+            if run_manager is not None:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
@@ -0,0 +1,195 @@
+import os
+import re
+import threading
+import time
+
+import numpy as np
+
+import metrics
+import reranker
+
+from web_search import normalize_query
+
+
+DEFAULT_CAPACITY = 50_000
+DEFAULT_THRESHOLD = 0.95
+DEFAULT_TTL = 6 * 3600
+INITIAL_ROWS = 1024
+_WORD = re.compile(r"\w+")
+
+
+class CachedAnswer:
+    """
+    An answer stored in the semantic cache.
+
+    :param query: The query the answer was generated for.
+    :param answer: The answer text.
+    :param sources: URLs of the documents the answer cites, in citation order.
+    :param similarity: Cosine similarity between the looked up query and ``query``; 1.0 for exact matches.
+    """
+
+    def __init__(self, query: str, answer: str, sources: list[str], similarity: float = 1.0):
+        self.query = query
+        self.answer = answer
+        self.sources = sources
+        self.similarity = similarity
+
+
+def guard_tokens(query: str) -> frozenset:
+    """
+    Tokens two queries must share for one's answer to be served for the other: tokens with digits
+    (numbers, years, dates, versions) and capitalized words after the first one (names, places).
+    Embeddings barely tell such queries apart, e.g. the same question about 2023 and 2024.
+    """
+
+    words = _WORD.findall(query)
+    return frozenset(word.lower() for i, word in enumerate(words)
+                     if any(c.isdigit() for c in word) or (i > 0 and word[0].isupper()))
+
+
+class SemanticAnswerCache:
+    """
+    Cache of generated answers looked up by query meaning.
+
+    Normalized e5 query embeddings are kept in one float32 matrix, grown by doubling up to ``capacity`` rows,
+    so a lookup is a single matrix-vector product that takes tens of milliseconds at hundreds of thousands
+    of entries on a CPU. Queries that are equal after normalization skip the embedding entirely.
+    Entries live for ``ttl`` seconds; when the cache is full the least recently used entry is replaced.
+    A semantic hit also needs the same guard_tokens as the stored query, since queries that differ only
+    by a number, a date or a name embed almost identically.
+
+    :param capacity: Maximum number of stored answers.
+    :param threshold: Minimum cosine similarity for a semantic hit.
+    :param ttl: Lifetime of an entry in seconds.
+    """
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY, threshold: float = DEFAULT_THRESHOLD, ttl: float = DEFAULT_TTL):
+        self.capacity = capacity
+        self.threshold = threshold
+        self.ttl = ttl
+        self.hits = 0
+        self.exact_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._matrix = None
+        self._entries = [None] * capacity
+        self._keys = [None] * capacity
+        self._guards = [None] * capacity
+        self._stored_at = np.full(capacity, -np.inf)
+        self._used_at = np.full(capacity, -np.inf)
+        self._exact = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _embed(self, query: str) -> np.ndarray:
+        embedding = np.asarray(reranker.batch_encode([query], is_query=True)[0], dtype=np.float32)
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm else embedding
+
+    def _is_fresh(self, row: int, now: float) -> bool:
+        return now - self._stored_at[row] <= self.ttl
+
+    def _hit(self, row: int, now: float, similarity: float) -> CachedAnswer:
+        self._used_at[row] = now
+        entry = self._entries[row]
+        return CachedAnswer(entry.query, entry.answer, entry.sources, similarity)
+
+    def get(self, query: str) -> CachedAnswer | None:
+        """
+        Looks up an answer for the query: first by exact normalized text, then by embedding similarity.
+
+        :param query: The query.
+        :return: The cached answer with its similarity, or None.
+        """
+
+        key = normalize_query(query)
+        now = time.monotonic()
+        with self._lock:
+            row = self._exact.get(key)
+            if row is not None and self._is_fresh(row, now):
+                self.exact_hits += 1
+                metrics.cache_hit("answer_exact")
+                return self._hit(row, now, 1.0)
+            if self._size == 0:
+                self.misses += 1
+                metrics.cache_miss("answer")
+                return None
+
+        embedding = self._embed(query)
+        now = time.monotonic()
+        with self._lock:
+            similarities = self._matrix[:self._size] @ embedding
+            similarities[now - self._stored_at[:self._size] > self.ttl] = -np.inf
+            guards = guard_tokens(query)
+            candidates = np.flatnonzero(similarities >= self.threshold)
+            for row in candidates[np.argsort(-similarities[candidates])]:
+                if self._guards[row] == guards:
+                    self.hits += 1
+                    metrics.cache_hit("answer")
+                    return self._hit(int(row), now, float(similarities[row]))
+            self.misses += 1
+            metrics.cache_miss("answer")
+            return None
+
+    def _free_row(self, now: float) -> int:
+        if self._size < self.capacity:
+            if self._size == len(self._matrix):
+                grown = np.zeros((min(self.capacity, 2 * len(self._matrix)), self._matrix.shape[1]), dtype=np.float32)
+                grown[:self._size] = self._matrix
+                self._matrix = grown
+            self._size += 1
+            return self._size - 1
+        expired = np.flatnonzero(now - self._stored_at > self.ttl)
+        row = int(expired[0]) if len(expired) else int(np.argmin(self._used_at))
+        self._exact.pop(self._keys[row], None)
+        self.evictions += 1
+        return row
+
+    def put(self, query: str, answer: str, sources: list[str]):
+        """
+        Stores an answer.
+
+        :param query: The query the answer was generated for.
+        :param answer: The answer text.
+        :param sources: URLs of the cited documents.
+        """
+
+        if self.capacity == 0:
+            return
+        key = normalize_query(query)
+        embedding = self._embed(query)
+        now = time.monotonic()
+        with self._lock:
+            if self._matrix is None:
+                self._matrix = np.zeros((min(self.capacity, INITIAL_ROWS), len(embedding)), dtype=np.float32)
+            row = self._exact.get(key)
+            if row is None:
+                row = self._free_row(now)
+            self._matrix[row] = embedding
+            self._entries[row] = CachedAnswer(query, answer, list(sources))
+            self._keys[row] = key
+            self._guards[row] = guard_tokens(query)
+            self._stored_at[row] = now
+            self._used_at[row] = now
+            self._exact[key] = row
+
+    def __len__(self):
+        """Number of entries that have not expired."""
+        with self._lock:
+            return int(np.count_nonzero(time.monotonic() - self._stored_at[:self._size] <= self.ttl))
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self),
+            "hits": self.hits,
+            "exact_hits": self.exact_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+answer_cache = SemanticAnswerCache(
+    capacity=int(os.getenv("ANSWER_CACHE_SIZE", DEFAULT_CAPACITY)),
+    threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", DEFAULT_THRESHOLD)),
+    ttl=float(os.getenv("ANSWER_CACHE_TTL", DEFAULT_TTL)),
+)
@@ -1,16 +1,12 @@
-from models import llm
-from langchain_core.messages import SystemMessage, HumanMessage
-
-def generate_answer(query, documents: list[str]) -> str:
-    """
-    Генерирует ответ на основе полученного из интернета контекста (documents) и пользовательского запроса (query).
+import metrics
 
-    :param query: Пользовательский вопрос
-    :param documents: Список строк с контекстом (результатами поиска), каждая строка включает ссылку
-    :return: Ответ, основанный только на этих документах
-    """
+from models import get_llm, response_text
+from documents import Document
+from session import format_history
+from langchain_core.messages import SystemMessage, HumanMessage
 
-    context = "\n\n".join(f"[{i+1}] {url}, {doc}" for i, (url, doc) in enumerate(documents)) if documents else "нет"
+def _build_messages(query, documents, history=None):
+    context = "\n\n".join(f"[{i+1}] {doc.url}, {doc.text}" for i, doc in enumerate(documents)) if documents else "нет"
 
     system_prompt = SystemMessage(
         content=(
@@ -21,12 +17,45 @@ def generate_answer(query, documents: list[str]) -> str:
         )
     )
 
+    dialog = format_history(history)
+    if dialog:
+        dialog += "\n\n"
     human_prompt = HumanMessage(
         content=(
+            f"{dialog}"
             f"Контекст из интернета:\n{context}\n\n"
             f"Вопрос пользователя: \"{query}\"\n\n"
             "Ответь на этот вопрос, используя только указанный контекст и добавляя ссылки на источники."
         )
     )
 
-    return llm.invoke([system_prompt, human_prompt]).strip()
\ No newline at end of file
+    return [system_prompt, human_prompt]
+
+def generate_answer(query, documents: list[Document], history: list[str] | None = None) -> str:
+    """
+    Генерирует ответ на основе полученного из интернета контекста (documents) и пользовательского запроса (query).
+
+    :param query: Пользовательский вопрос
+    :param documents: Документы с контекстом (результатами поиска): ссылка и извлечённый текст
+    :param history: Предыдущие реплики диалога ("Пользователь: ...", "AI-агент: ..."), чтобы понимать уточняющие вопросы
+    :return: Ответ, основанный только на этих документах
+    """
+
+    with metrics.span("generate"):
+        return get_llm().invoke(_build_messages(query, documents, history)).strip()
+
+def generate_answer_stream(query, documents: list[Document], history: list[str] | None = None):
+    """
+    То же, что generate_answer, но отдаёт ответ по частям, по мере того как их возвращает LLM.
+
+    :param query: Пользовательский вопрос
+    :param documents: Документы с контекстом (результатами поиска): ссылка и извлечённый текст
+    :param history: Предыдущие реплики диалога ("Пользователь: ...", "AI-агент: ..."), чтобы понимать уточняющие вопросы
+    :return: Итератор фрагментов ответа
+    """
+
+    with metrics.span("generate", mode="stream"):
+        for chunk in get_llm().stream(_build_messages(query, documents, history)):
+            text = response_text(chunk)
+            if text:
+                yield text
\ No newline at end of file
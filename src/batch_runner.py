@@ -0,0 +1,233 @@
+"""
+Batch mode: runs the pipeline over a JSONL file of queries and writes one JSONL line per query
+with the answer, its sources and per-stage timings.
+
+    python src/batch_runner.py queries.jsonl answers.jsonl --concurrency 16
+
+Queries are processed concurrently on one event loop, so they share the page cache, in-flight
+downloads of the same URL, the search cache and the model batches of the inference service.
+Search, fetch and LLM calls are limited separately across all queries. Every finished query is
+appended to the output right away; after a crash the same command skips the queries already in
+the output and retries the ones that failed.
+"""
+
+import os
+import json
+import time
+import asyncio
+import logging
+import argparse
+
+from concurrent.futures import ThreadPoolExecutor
+
+from fetcher import run_sync
+from pipeline import RetrievalPipeline, PipelineResult, HEDGE_AFTER
+
+logger = logging.getLogger(__name__)
+
+ID_FIELDS = ("id", "request_id", "query_id")
+QUERY_FIELDS = ("query", "question", "text", "title")
+
+
+def _pick_field(record: dict, field: str | None, candidates: tuple) -> str | None:
+    if field is not None:
+        return field if field in record else None
+    return next((name for name in candidates if name in record), None)
+
+
+def read_queries(path: str, id_field: str | None = None, query_field: str | None = None) -> list[tuple[str, str]]:
+    """
+    Reads (id, query) pairs from a JSONL file.
+
+    :param path: Input file, one JSON object per line.
+    :param id_field: Field with the query id; the first of ID_FIELDS present if None, else the line number.
+    :param query_field: Field with the query text; the first of QUERY_FIELDS present if None.
+    :return: List of (id, query) in file order.
+    """
+
+    queries = []
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            text_field = _pick_field(record, query_field, QUERY_FIELDS)
+            if text_field is None:
+                raise Exception(f"{path}:{line_number}: no query field in {sorted(record)}")
+            key_field = _pick_field(record, id_field, ID_FIELDS)
+            query_id = str(record[key_field]) if key_field is not None else str(line_number)
+            queries.append((query_id, str(record[text_field])))
+    return queries
+
+
+def completed_ids(path: str) -> set[str]:
+    """Ids of the queries already answered in an output file; failed and cut-off lines do not count."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line of a run that was killed while writing
+                continue
+            if record.get("error") is None:
+                done.add(str(record["id"]))
+    return done
+
+
+def result_record(query_id: str, result: PipelineResult) -> dict:
+    return {
+        "id": query_id,
+        "query": result.query,
+        "answer": result.answer,
+        "sources": [document.url for document in result.documents],
+        "paraphrases": result.paraphrases,
+        "timings": {stage: round(seconds, 3) for stage, seconds in result.timings.items()},
+        "total": round(result.elapsed(), 3),
+        "over_budget": result.over_budget,
+        "cached": result.cached is not None,
+        "error": None,
+    }
+
+
+class _ParaphraseBatches:
+    """
+    Paraphrases the queries in batches of ``batch_size``, filling the paraphrase cache before they run.
+    A batch starts when a worker reaches its first query; the other workers on that batch wait for it
+    instead of paraphrasing their queries again.
+    """
+
+    def __init__(self, pipeline: RetrievalPipeline, queries: list[str], batch_size: int):
+        self.pipeline = pipeline
+        self.batches = [queries[start:start + batch_size] for start in range(0, len(queries), batch_size)]
+        self.batch_of = {query: i for i, batch in enumerate(self.batches) for query in batch}
+        self.tasks = {}
+
+    async def _paraphrase(self, batch: list[str]):
+        try:
+            await self.pipeline.paraphrase_many(batch)
+        except Exception as e:
+            logger.warning("Batched paraphrasing failed, queries will be paraphrased one by one: %r", e)
+
+    async def wait(self, query: str):
+        i = self.batch_of.get(query)
+        if i is None:
+            return
+        if i not in self.tasks:
+            self.tasks[i] = asyncio.ensure_future(self._paraphrase(self.batches[i]))
+        await asyncio.shield(self.tasks[i])
+
+    def cancel(self):
+        for task in self.tasks.values():
+            task.cancel()
+
+
+async def run_batch(pipeline: RetrievalPipeline, queries: list[tuple[str, str]], out_path: str,
+                    concurrency: int = 8, deadline: float | None = None, paraphrase_batch: int = 16) -> dict:
+    """
+    Runs the pipeline for every query and appends the results to ``out_path``.
+
+    :param pipeline: Pipeline shared by all queries.
+    :param queries: (id, query) pairs; ids already answered in ``out_path`` are skipped.
+    :param out_path: Output JSONL file, appended to.
+    :param concurrency: Number of queries in flight at the same time.
+    :param deadline: Per-query deadline passed to the pipeline; the pipeline's own if None.
+    :param paraphrase_batch: Queries paraphrased together before they run; 0 disables it.
+    :return: Counts of answered, failed and skipped queries.
+    """
+
+    done = completed_ids(out_path)
+    todo = [(query_id, query) for query_id, query in queries if query_id not in done]
+    pending = asyncio.Queue()
+    for item in todo:
+        pending.put_nowait(item)
+    stats = {"answered": 0, "failed": 0, "skipped": len(queries) - len(todo)}
+    total = len(todo)
+    started = time.perf_counter()
+    batches = None
+    if paraphrase_batch:
+        batches = _ParaphraseBatches(pipeline, [query for _, query in todo], paraphrase_batch)
+
+    if os.path.exists(out_path) and os.path.getsize(out_path):
+        with open(out_path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            cut_off = f.read(1) != b"\n"
+    else:
+        cut_off = False
+
+    with open(out_path, "a", encoding="utf-8") as out:
+        if cut_off:
+            out.write("\n")
+
+        def write(record: dict):
+            # Flushed line by line, so a crash loses at most the queries in flight
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+
+        async def worker():
+            while not pending.empty():
+                query_id, query = pending.get_nowait()
+                try:
+                    if batches is not None:
+                        await batches.wait(query)
+                    result = await pipeline.run(query, deadline)
+                except Exception as e:
+                    logger.warning("Query %s failed: %r", query_id, e)
+                    write({"id": query_id, "query": query, "error": repr(e)})
+                    stats["failed"] += 1
+                else:
+                    write(result_record(query_id, result))
+                    stats["answered"] += 1
+                finished = stats["answered"] + stats["failed"]
+                if finished % 10 == 0 or finished == total:
+                    elapsed = time.perf_counter() - started
+                    logger.info("%d/%d queries done, %.2f queries/s", finished, total, finished / elapsed)
+
+        try:
+            await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+        finally:
+            if batches is not None:
+                batches.cancel()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="JSONL file with the queries")
+    parser.add_argument("output", help="JSONL file the answers are appended to; also the checkpoint")
+    parser.add_argument("--id-field", help=f"field with the query id (default: first of {', '.join(ID_FIELDS)})")
+    parser.add_argument("--query-field", help=f"field with the query text (default: first of {', '.join(QUERY_FIELDS)})")
+    parser.add_argument("--concurrency", type=int, default=8, help="queries in flight at the same time")
+    parser.add_argument("--search-limit", type=int, default=8, help="search calls in flight across all queries")
+    parser.add_argument("--fetch-limit", type=int, default=64, help="page downloads in flight across all queries")
+    parser.add_argument("--llm-limit", type=int, default=4, help="LLM calls in flight across all queries")
+    parser.add_argument("--deadline", type=float, help="per-query deadline in seconds before reranking")
+    parser.add_argument("--hedge-after", type=float, default=HEDGE_AFTER,
+                        help="seconds after which a slow search call is sent again, e.g. the search p95 "
+                             "(default: HEDGE_AFTER env var, else off)")
+    parser.add_argument("--paraphrase-batch", type=int, default=16,
+                        help="queries paraphrased together before they run; 0 disables it")
+    parser.add_argument("--no-answer-cache", action="store_true",
+                        help="answer every query from scratch, e.g. for evaluation runs")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    queries = read_queries(args.input, args.id_field, args.query_field)
+
+    # Blocking search and LLM calls hold a thread each; the models have their own inference thread
+    executor = ThreadPoolExecutor(max_workers=args.search_limit + args.llm_limit + args.concurrency,
+                                  thread_name_prefix="batch")
+    options = {} if not args.no_answer_cache else {"answer_cache": None}
+    pipeline = RetrievalPipeline(executor=executor, search_limit=args.search_limit, fetch_limit=args.fetch_limit,
+                                 llm_limit=args.llm_limit, hedge_after=args.hedge_after or None, **options)
+    try:
+        stats = run_sync(run_batch(pipeline, queries, args.output, args.concurrency, args.deadline, args.paraphrase_batch))
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    print(f"{stats['answered']} answered, {stats['failed']} failed, {stats['skipped']} already done -> {args.output}")
+
+
+if __name__ == "__main__":
+    main()
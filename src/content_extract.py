@@ -0,0 +1,218 @@
+import io
+import re
+
+try:
+    import lxml.etree
+    import lxml.html
+    HAS_LXML = True
+except ImportError:
+    HAS_LXML = False
+
+
+MAX_INPUT_BYTES = 2 * 1024 * 1024
+
+BINARY_CONTENT_TYPES = (
+    "image/", "audio/", "video/", "font/",
+    "application/octet-stream", "application/zip", "application/gzip", "application/x-",
+    "application/vnd.", "application/msword",
+)
+BINARY_SIGNATURES = (b"\x89PNG", b"GIF8", b"\xff\xd8\xff", b"PK\x03\x04", b"\x1f\x8b", b"RIFF")
+PDF_SIGNATURE = b"%PDF-"
+
+BOILERPLATE_TAGS = (
+    "script", "style", "noscript", "template", "iframe", "svg", "canvas", "object", "embed",
+    "nav", "header", "footer", "aside", "form", "button", "input", "select", "textarea", "dialog",
+)
+BOILERPLATE_PATTERN = re.compile(
+    r"(^|[\s_-])(cookies?|consent|gdpr|banner|popup|modal|overlay|subscribe|newsletter|promo|advert|ads?|"
+    r"sidebar|share|social|breadcrumbs?|navbar|menu|footer|header|related|comments?)([\s_-]|$)",
+    re.IGNORECASE,
+)
+KEEP_TAGS = {"html", "body", "main", "article"}
+HEADING_TAGS = {"h1", "h2", "h3", "h4", "h5", "h6"}
+BLOCK_TAGS = {
+    "p", "div", "section", "article", "main", "blockquote", "ul", "ol", "dl", "dt", "dd",
+    "table", "tr", "figure", "figcaption", "details", "summary", "address", "hr",
+}
+SCORED_TAGS = ("p", "pre", "td", "blockquote")
+MIN_PARAGRAPH_CHARS = 25
+MIN_MAIN_CHARS = 200
+# Wrappers matching the boilerplate pattern are kept when they hold this much non-link text
+MAX_BOILERPLATE_CHARS = 2000
+
+_WHITESPACE = re.compile(r"\s+")
+_BLANK_LINES = re.compile(r"\n{3,}")
+
+
+class UnsupportedContent(Exception):
+    pass
+
+
+def is_binary_content_type(content_type: str) -> bool:
+    content_type = content_type.lower()
+    return content_type.startswith(BINARY_CONTENT_TYPES) and "xml" not in content_type
+
+
+def sniff_kind(content_type: str, head: bytes) -> str:
+    """
+    Kind of a response body from its Content-Type and first bytes: "html", "pdf" or "binary".
+    """
+
+    content_type = content_type.lower()
+    if "pdf" in content_type or head.startswith(PDF_SIGNATURE):
+        return "pdf"
+    if is_binary_content_type(content_type) or head.startswith(BINARY_SIGNATURES):
+        return "binary"
+    return "html"
+
+
+def _drop_boilerplate(root):
+    for el in list(root.iter(*BOILERPLATE_TAGS)):
+        el.drop_tree()
+    for el in list(root.iter()):
+        if isinstance(el.tag, str) and (el.get("aria-hidden") == "true"
+                                        or "display:none" in el.get("style", "").replace(" ", "")):
+            el.drop_tree()
+
+    # Wrappers of the main content are kept even if their class looks like boilerplate
+    # (e.g. <div class="page header-fixed"> around a short article)
+    protected = set(_main_node(root, min_chars=0).iterancestors())
+    for el in list(root.iter()):
+        if not isinstance(el.tag, str) or el.tag in KEEP_TAGS or el in protected:
+            continue
+        marker = f"{el.get('class', '')} {el.get('id', '')} {el.get('role', '')}"
+        if marker.strip() and BOILERPLATE_PATTERN.search(marker):
+            if len(el.text_content()) < MAX_BOILERPLATE_CHARS or _link_density(el) > 0.5:
+                el.drop_tree()
+
+
+def _link_density(node) -> float:
+    text_length = len(node.text_content())
+    if not text_length:
+        return 1.0
+    link_length = sum(len(a.text_content()) for a in node.iter("a"))
+    return link_length / text_length
+
+
+def _main_node(root, min_chars: int = MIN_MAIN_CHARS):
+    """
+    Picks the element holding the main content.
+
+    An explicit <main>/<article> wins if it has at least ``min_chars`` of text; otherwise paragraphs vote
+    for their parent (and, with half the weight, grandparent) and the best voted node, discounted by its
+    link density, is used. The whole root is returned if that node is shorter than ``min_chars``.
+    """
+
+    explicit = root.xpath("//main|//article|//*[@role='main']")
+    explicit = [node for node in explicit if len(node.text_content()) >= min_chars]
+    if explicit:
+        return max(explicit, key=lambda node: len(node.text_content()))
+
+    scores = {}
+    for paragraph in root.iter(*SCORED_TAGS):
+        text = paragraph.text_content()
+        if len(text.strip()) < MIN_PARAGRAPH_CHARS:
+            continue
+        score = 1 + text.count(",") + min(len(text) // 100, 3)
+        parent = paragraph.getparent()
+        if parent is None:
+            continue
+        scores[parent] = scores.get(parent, 0) + score
+        grandparent = parent.getparent()
+        if grandparent is not None:
+            scores[grandparent] = scores.get(grandparent, 0) + score / 2
+
+    if not scores:
+        return root
+    best = max(scores, key=lambda node: scores[node] * (1 - _link_density(node)))
+    return best if len(best.text_content()) >= min_chars else root
+
+
+def _render(el, parts: list[str], with_tail: bool = True):
+    if not isinstance(el.tag, str):
+        # Comments and processing instructions: only the text after them is content
+        if el.tail:
+            parts.append(_WHITESPACE.sub(" ", el.tail))
+        return
+
+    tag = el.tag.lower()
+    if tag == "pre":
+        parts.append("\n\n```\n" + el.text_content().strip("\n") + "\n```\n\n")
+    else:
+        if tag in HEADING_TAGS:
+            parts.append("\n\n" + "#" * int(tag[1]) + " ")
+        elif tag == "li":
+            parts.append("\n- ")
+        elif tag == "br":
+            parts.append("\n")
+        elif tag in ("td", "th"):
+            parts.append(" | ")
+        elif tag in BLOCK_TAGS:
+            parts.append("\n\n")
+
+        if el.text:
+            parts.append(_WHITESPACE.sub(" ", el.text))
+        for child in el:
+            _render(child, parts)
+
+        if tag in HEADING_TAGS or tag in BLOCK_TAGS:
+            parts.append("\n\n")
+
+    if with_tail and el.tail:
+        parts.append(_WHITESPACE.sub(" ", el.tail))
+
+
+def extract_markdown(content: bytes, encoding: str | None = None, max_bytes: int = MAX_INPUT_BYTES) -> str:
+    """
+    Extracts the main content of an HTML page as markdown-like text.
+
+    Parses with lxml, drops scripts, navigation, footers, cookie banners and similar boilerplate,
+    finds the main content block and renders headings, paragraphs, lists, code and tables.
+
+    :param content: Raw HTML bytes; only the first max_bytes are parsed.
+    :param encoding: Charset from the HTTP headers, if any; otherwise lxml detects it from the page.
+    :param max_bytes: Hard limit on the parsed input size.
+    :return: Markdown-like text of the main content.
+    """
+
+    content = content[:max_bytes]
+    if not content.strip():
+        return ""
+    try:
+        parser = lxml.html.HTMLParser(encoding=encoding, remove_comments=True, remove_pis=True)
+    except LookupError:
+        # Unknown charset name in the headers: let lxml detect it
+        parser = lxml.html.HTMLParser(remove_comments=True, remove_pis=True)
+    try:
+        root = lxml.html.document_fromstring(content, parser=parser)
+    except lxml.etree.ParserError:
+        # Nothing but comments or whitespace: an empty page, cached like any other
+        return ""
+    body = root.find("body")
+    root = body if body is not None else root
+
+    _drop_boilerplate(root)
+    parts = []
+    _render(_main_node(root), parts, with_tail=False)
+
+    lines = []
+    in_code = False
+    for line in "".join(parts).split("\n"):
+        if line.strip() == "```":
+            in_code = not in_code
+        lines.append(line.rstrip() if in_code else line.strip())
+    return _BLANK_LINES.sub("\n\n", "\n".join(lines)).strip()
+
+
+def extract_pdf_text(content: bytes) -> str:
+    """
+    Extracts the text of a PDF document; requires the optional pypdf package.
+    """
+
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise UnsupportedContent("PDF support requires the pypdf package")
+
+    reader = PdfReader(io.BytesIO(content))
+    return "\n\n".join(page.extract_text() or "" for page in reader.pages).strip()
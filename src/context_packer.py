@@ -0,0 +1,137 @@
+import os
+import re
+import math
+import logging
+import hashlib
+
+import numpy as np
+
+from documents import Document
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 4000))
+# Passages whose 64-bit SimHashes differ in at most this many bits are treated as duplicates
+MAX_HAMMING_DISTANCE = 3
+# Shorter passages (headings, captions) are never deduplicated: their SimHashes are too noisy
+MIN_DEDUP_WORDS = 8
+MIN_TRUNCATED_TOKENS = 64
+CHARS_PER_TOKEN = 4.0
+# Token counts are estimated, so they are inflated by this factor to stay within the real context window
+TOKEN_SAFETY_MARGIN = 1.25
+SHINGLE_SIZE = 3
+
+_WORD = re.compile(r"\w+")
+_BITS = np.arange(64, dtype=np.uint64)
+
+
+def count_tokens(texts: list[str]) -> list[int]:
+    """
+    Estimates the number of tokens of several texts from their length, with TOKEN_SAFETY_MARGIN on top.
+
+    GigaChat's tokenizer is only available on the server (``tokens_count``, which ``get_num_tokens``
+    calls too), and a round trip per query is too slow for packing the context.
+
+    :param texts: Texts to count.
+    :return: Estimated number of tokens of every text.
+    """
+
+    return [math.ceil(len(text) / CHARS_PER_TOKEN * TOKEN_SAFETY_MARGIN) for text in texts]
+
+
+def _hash64(items: list[str]) -> np.ndarray:
+    return np.array([int.from_bytes(hashlib.blake2b(item.encode("utf-8"), digest_size=8).digest(), "little")
+                     for item in items], dtype=np.uint64)
+
+
+def simhash(text: str) -> int:
+    """
+    64-bit SimHash of a text over its word shingles.
+
+    :param text: The text.
+    :return: The fingerprint; near-duplicate texts differ in few bits.
+    """
+
+    words = _WORD.findall(text.lower())
+    shingles = [" ".join(words[i:i + SHINGLE_SIZE]) for i in range(max(1, len(words) - SHINGLE_SIZE + 1))]
+    bits = (_hash64(shingles)[:, None] >> _BITS) & np.uint64(1)
+    votes = 2 * bits.sum(axis=0, dtype=np.int64) - len(shingles)
+    return int(np.sum(np.uint64(1) << _BITS[votes > 0], dtype=np.uint64))
+
+
+def _hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def _passages(text: str) -> list[str]:
+    return [passage for passage in text.split("\n\n") if passage.strip()]
+
+
+def pack_context(documents: list[Document], token_budget: int = CONTEXT_TOKEN_BUDGET,
+                 max_distance: int = MAX_HAMMING_DISTANCE) -> list[Document]:
+    """
+    Packs reranked documents into the LLM's context.
+
+    Documents are processed in the order given (best first). Passages that are near-duplicates of an
+    already kept passage are dropped. Then every document gets an equal share of the token budget,
+    and what the shorter ones leave over goes to the others in rank order; documents are cut at a passage
+    boundary, so a long document does not crowd the later ones out. The returned list keeps the input
+    order, so the [n] numbers in the prompt follow the reranker ranking.
+
+    :param documents: Documents sorted by reranker score; text passages are separated by blank lines.
+    :param token_budget: Maximum total number of tokens of the packed texts.
+    :param max_distance: SimHash Hamming distance at which two passages are duplicates.
+    :return: The packed documents; cut ones are copies with the shorter text.
+    """
+
+    seen = []
+    deduplicated = []
+    for document in documents:
+        kept = []
+        duplicates = 0
+        unique = 0
+        for passage in _passages(document.text):
+            if len(_WORD.findall(passage)) >= MIN_DEDUP_WORDS:
+                fingerprint = simhash(passage)
+                if any(_hamming(fingerprint, other) <= max_distance for other in seen):
+                    duplicates += 1
+                    continue
+                seen.append(fingerprint)
+                unique += 1
+            kept.append(passage)
+        # A mirror keeps nothing but its headings: drop it entirely
+        if kept and (unique or not duplicates):
+            deduplicated.append((document, kept))
+
+    counts = iter(count_tokens([passage for _, passages in deduplicated for passage in passages]))
+    tokens = [[next(counts) for _ in passages] for _, passages in deduplicated]
+    taken = [0] * len(deduplicated)
+    taken_tokens = [0] * len(deduplicated)
+    remaining = token_budget
+
+    def take(i: int, limit: int):
+        nonlocal remaining
+        # Passages are taken in order while the document stays within limit
+        while taken[i] < len(tokens[i]) and taken_tokens[i] + tokens[i][taken[i]] <= limit:
+            cost = tokens[i][taken[i]]
+            if cost > remaining:
+                break
+            taken_tokens[i] += cost
+            remaining -= cost
+            taken[i] += 1
+
+    share = token_budget // max(1, len(deduplicated))
+    for i in range(len(deduplicated)):
+        take(i, share)
+    for i in range(len(deduplicated)):
+        take(i, taken_tokens[i] + remaining)
+
+    packed = []
+    for (document, passages), count, used in zip(deduplicated, taken, taken_tokens):
+        # A cut document is only worth keeping if a meaningful part of it fits
+        if count and (count == len(passages) or used >= MIN_TRUNCATED_TOKENS):
+            text = "\n\n".join(passages[:count])
+            packed.append(document if text == document.text else document.with_text(text))
+
+    logger.info("Packed %d of %d documents into the context", len(packed), len(documents))
+    return packed
@@ -0,0 +1,81 @@
+import numpy as np
+
+
+class Document:
+    """
+    A page extracted for one query, carried from extraction through reranking to the answer.
+
+    :param id: Number of the document within its run; unique even when two pages extract the same text.
+    :param url: The page's URL.
+    :param text: Extracted relevant chunks, separated by blank lines.
+    :param chunk_scores: Cross-encoder scores of the chunks in ``text``, in the same order.
+    :param emb_row: Row of the document's embedding in the run's EmbeddingMatrix, -1 if not embedded.
+    """
+
+    __slots__ = ("id", "url", "text", "chunk_scores", "emb_row")
+
+    def __init__(self, id: int, url: str, text: str, chunk_scores: np.ndarray | None = None, emb_row: int = -1):
+        self.id = id
+        self.url = url
+        self.text = text
+        self.chunk_scores = chunk_scores
+        self.emb_row = emb_row
+
+    @property
+    def score(self) -> float:
+        """Best chunk score, -inf if the document was not scored."""
+        if self.chunk_scores is None or len(self.chunk_scores) == 0:
+            return float("-inf")
+        return float(self.chunk_scores.max())
+
+    def with_text(self, text: str) -> "Document":
+        """The same document with its text replaced, e.g. cut to the context budget."""
+        return Document(self.id, self.url, text, self.chunk_scores, self.emb_row)
+
+    def __repr__(self):
+        return f"Document(id={self.id}, url={self.url!r}, chars={len(self.text)}, emb_row={self.emb_row})"
+
+
+class EmbeddingMatrix:
+    """
+    One float32 matrix holding the embeddings of all documents of a run, a row per document.
+
+    Rows are appended as pages are extracted; the matrix doubles its capacity when full,
+    so documents only keep a row index and reranking slices the rows it needs.
+
+    :param capacity: Rows allocated up front.
+    """
+
+    def __init__(self, capacity: int = 64):
+        self.capacity = capacity
+        self._matrix = None
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, embeddings: np.ndarray) -> range:
+        """
+        Appends embeddings and returns their row indices.
+
+        :param embeddings: 2D array with one embedding per row.
+        """
+
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if len(embeddings) == 0:
+            return range(self._size, self._size)
+        if self._matrix is None:
+            self._matrix = np.empty((max(self.capacity, len(embeddings)), embeddings.shape[1]), dtype=np.float32)
+        needed = self._size + len(embeddings)
+        if needed > len(self._matrix):
+            grown = np.empty((max(needed, 2 * len(self._matrix)), self._matrix.shape[1]), dtype=np.float32)
+            grown[:self._size] = self._matrix[:self._size]
+            self._matrix = grown
+        self._matrix[self._size:needed] = embeddings
+        rows = range(self._size, needed)
+        self._size = needed
+        return rows
+
+    def rows(self, documents: list[Document]) -> np.ndarray:
+        """Embeddings of the given documents, in their order."""
+        return self._matrix[[document.emb_row for document in documents]]
@@ -0,0 +1,284 @@
+import os
+import atexit
+import sqlite3
+import threading
+import time
+
+from urllib.parse import urlsplit
+
+from utils import cache_path
+
+
+DEFAULT_ALPHA = 0.2
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_MAX_FAILURE_RATE = 0.8
+DEFAULT_MIN_REQUESTS = 10
+DEFAULT_COOLDOWN = 600
+DEFAULT_FLUSH_INTERVAL = 30
+# Priors of a domain that was never fetched
+PRIOR_LATENCY = 1.0
+USEFUL_CONTENT_CHARS = 4000
+LATENCY_SCALE = 2.0
+# HTTP statuses that say nothing about the domain, only about the URL
+URL_STATUSES = (404, 410)
+
+
+class CircuitOpen(Exception):
+    """Raised instead of fetching a page from a domain whose circuit is open."""
+
+
+def domain_of(url: str) -> str:
+    host = (urlsplit(url).hostname or "").lower()
+    return host[4:] if host.startswith("www.") else host
+
+
+class DomainStats:
+    """
+    Health of one domain.
+
+    :param domain: Host name without "www.".
+    :param latency: EWMA of the download time in seconds.
+    :param failure_rate: EWMA of failures (timeouts, connection errors, 403/429/5xx), between 0 and 1.
+    :param content_size: EWMA of the extracted content length in characters.
+    :param requests: Number of downloads recorded.
+    :param failures: Number of failed downloads recorded.
+    :param consecutive_failures: Failures since the last success.
+    :param open_until: Time until which the circuit is open; 0 if it is closed.
+    """
+
+    __slots__ = ("domain", "latency", "failure_rate", "content_size", "requests", "failures",
+                 "consecutive_failures", "open_until", "updated_at")
+
+    def __init__(self, domain: str, latency: float = PRIOR_LATENCY, failure_rate: float = 0.0,
+                 content_size: float = USEFUL_CONTENT_CHARS, requests: int = 0, failures: int = 0,
+                 consecutive_failures: int = 0, open_until: float = 0.0, updated_at: float = 0.0):
+        self.domain = domain
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.content_size = content_size
+        self.requests = requests
+        self.failures = failures
+        self.consecutive_failures = consecutive_failures
+        self.open_until = open_until
+        self.updated_at = updated_at
+
+    def state(self, now: float | None = None) -> str:
+        if not self.open_until:
+            return "closed"
+        return "open" if self.open_until > (now or time.time()) else "half-open"
+
+    def usefulness(self, now: float | None = None) -> float:
+        """
+        Expected value of fetching a page from the domain, between 0 and 1: the chance it succeeds,
+        times how much content it usually has, discounted by how long it usually takes.
+        """
+
+        if self.state(now) == "open":
+            return 0.0
+        size = min(1.0, self.content_size / USEFUL_CONTENT_CHARS) ** 0.5
+        return (1 - self.failure_rate) * size / (1 + self.latency / LATENCY_SCALE)
+
+    def as_dict(self) -> dict:
+        return {
+            "domain": self.domain,
+            "state": self.state(),
+            "latency": round(self.latency, 3),
+            "failure_rate": round(self.failure_rate, 3),
+            "content_size": round(self.content_size),
+            "requests": self.requests,
+            "failures": self.failures,
+            "usefulness": round(self.usefulness(), 3),
+        }
+
+
+class DomainHealth:
+    """
+    Per-domain download statistics with a circuit breaker.
+
+    Every download updates the domain's latency, failure rate and content size EWMAs. After
+    ``failure_threshold`` failures in a row, or once the failure rate of a domain with at least
+    ``min_requests`` downloads reaches ``max_failure_rate``, the circuit opens and the domain is not
+    fetched for ``cooldown`` seconds. Then a single probe is let through: a success closes the circuit,
+    a failure keeps it open for another cooldown.
+
+    The statistics are kept in memory and written to SQLite at most every ``flush_interval`` seconds,
+    in a background thread, so they survive restarts without blocking the event loop.
+
+    :param path: SQLite file; None keeps the statistics in memory only.
+    :param alpha: Weight of the newest observation in the EWMAs.
+    """
+
+    def __init__(self, path: str | None = None, alpha: float = DEFAULT_ALPHA,
+                 failure_threshold: int = DEFAULT_FAILURE_THRESHOLD, max_failure_rate: float = DEFAULT_MAX_FAILURE_RATE,
+                 min_requests: int = DEFAULT_MIN_REQUESTS, cooldown: float = DEFAULT_COOLDOWN,
+                 flush_interval: float = DEFAULT_FLUSH_INTERVAL):
+        self.path = path
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.max_failure_rate = max_failure_rate
+        self.min_requests = min_requests
+        self.cooldown = cooldown
+        self.flush_interval = flush_interval
+        self._domains = {}
+        self._dirty = set()
+        self._flushed_at = time.monotonic()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._conn = None
+        if path:
+            self._load()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS domains (
+                    {", ".join(f"{name} {'TEXT PRIMARY KEY' if name == 'domain' else 'REAL'}" for name in DomainStats.__slots__)}
+                )""")
+        return self._conn
+
+    def _load(self):
+        columns = ", ".join(DomainStats.__slots__)
+        for row in self._connection().execute(f"SELECT {columns} FROM domains"):
+            stats = DomainStats(*row)
+            stats.requests, stats.failures, stats.consecutive_failures = map(int, row[4:7])
+            self._domains[stats.domain] = stats
+
+    def flush(self):
+        """Writes the changed domains to disk."""
+        # Downloads keep recording while the rows are written; only the snapshot is taken under their lock
+        with self._write_lock:
+            with self._lock:
+                rows = [tuple(getattr(self._domains[domain], name) for name in DomainStats.__slots__)
+                        for domain in self._dirty]
+                self._dirty.clear()
+                self._flushed_at = time.monotonic()
+            if not rows or not self.path:
+                return
+            placeholders = ", ".join("?" * len(DomainStats.__slots__))
+            conn = self._connection()
+            conn.execute("BEGIN")
+            conn.executemany(f"INSERT OR REPLACE INTO domains VALUES ({placeholders})", rows)
+            conn.execute("COMMIT")
+
+    def _get(self, domain: str) -> DomainStats:
+        stats = self._domains.get(domain)
+        if stats is None:
+            stats = self._domains[domain] = DomainStats(domain)
+        return stats
+
+    def _updated(self, stats: DomainStats):
+        stats.updated_at = time.time()
+        self._dirty.add(stats.domain)
+
+    def _maybe_flush(self):
+        with self._lock:
+            if not self.path or time.monotonic() - self._flushed_at < self.flush_interval:
+                return
+            self._flushed_at = time.monotonic()
+        threading.Thread(target=self.flush, name="domain-health-flush", daemon=True).start()
+
+    def _ewma(self, old: float, new: float) -> float:
+        return old + self.alpha * (new - old)
+
+    def allow(self, url: str) -> bool:
+        """
+        Whether a page of the URL's domain may be fetched now. Lets one probe through
+        when the cooldown of an open circuit is over.
+        """
+
+        now = time.time()
+        with self._lock:
+            stats = self._domains.get(domain_of(url))
+            if stats is None or not stats.open_until:
+                return True
+            if stats.open_until > now:
+                return False
+            # Half-open: this caller is the probe, everyone else waits for another cooldown
+            stats.open_until = now + self.cooldown
+            self._updated(stats)
+            return True
+
+    def record_success(self, url: str, elapsed: float, content_size: int):
+        """
+        Records a successful download.
+
+        :param url: The downloaded URL.
+        :param elapsed: Download time in seconds.
+        :param content_size: Length of the extracted content in characters.
+        """
+
+        with self._lock:
+            stats = self._get(domain_of(url))
+            first = stats.requests == 0
+            stats.latency = elapsed if first else self._ewma(stats.latency, elapsed)
+            stats.content_size = content_size if first else self._ewma(stats.content_size, content_size)
+            stats.failure_rate = self._ewma(stats.failure_rate, 0.0)
+            stats.requests += 1
+            stats.consecutive_failures = 0
+            stats.open_until = 0.0
+            self._updated(stats)
+        self._maybe_flush()
+
+    def record_failure(self, url: str, elapsed: float | None = None):
+        """
+        Records a failed download and opens the circuit if the domain keeps failing.
+
+        :param url: The URL that failed.
+        :param elapsed: Time until the failure in seconds, if known; timeouts make the domain look slow.
+        """
+
+        with self._lock:
+            stats = self._get(domain_of(url))
+            if elapsed is not None:
+                stats.latency = elapsed if stats.requests == 0 else self._ewma(stats.latency, elapsed)
+            stats.failure_rate = self._ewma(stats.failure_rate, 1.0)
+            stats.requests += 1
+            stats.failures += 1
+            stats.consecutive_failures += 1
+            if stats.consecutive_failures >= self.failure_threshold or (
+                    stats.requests >= self.min_requests and stats.failure_rate >= self.max_failure_rate):
+                stats.open_until = max(stats.open_until, time.time() + self.cooldown)
+            self._updated(stats)
+        self._maybe_flush()
+
+    def is_open(self, url: str) -> bool:
+        """Whether the circuit of the URL's domain is open, so its pages are not fetched now."""
+        stats = self._domains.get(domain_of(url))
+        return stats is not None and stats.state() == "open"
+
+    def usefulness(self, url: str) -> float:
+        """Expected usefulness of the URL's domain (see DomainStats.usefulness); domains never seen get the priors."""
+        stats = self._domains.get(domain_of(url))
+        return (stats or _UNKNOWN).usefulness()
+
+    def stats(self, domain: str | None = None) -> dict | list[dict]:
+        """
+        Statistics of one domain, or of all domains, the least useful first.
+        """
+
+        if domain is not None:
+            stats = self._domains.get(domain_of(f"//{domain}"))
+            return (stats or DomainStats(domain)).as_dict()
+        with self._lock:
+            rows = [stats.as_dict() for stats in self._domains.values()]
+        return sorted(rows, key=lambda row: row["usefulness"])
+
+
+_UNKNOWN = DomainStats("")
+
+# Set DOMAIN_HEALTH_PATH to an empty string to keep the statistics in memory only
+domain_health = DomainHealth(
+    os.getenv("DOMAIN_HEALTH_PATH", cache_path("domains.sqlite3")) or None,
+    failure_threshold=int(os.getenv("DOMAIN_FAILURE_THRESHOLD", DEFAULT_FAILURE_THRESHOLD)),
+    cooldown=float(os.getenv("DOMAIN_COOLDOWN", DEFAULT_COOLDOWN)),
+)
+atexit.register(domain_health.flush)
+
+
+if __name__ == "__main__":
+    for row in domain_health.stats():
+        print(f"{row['domain']:<40} {row['state']:<9} latency {row['latency']:6.2f}s  failures {row['failure_rate']:.2f}"
+              f"  content {row['content_size']:6d}  requests {row['requests']:5d}  usefulness {row['usefulness']:.2f}")
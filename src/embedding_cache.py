@@ -0,0 +1,205 @@
+import atexit
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+
+from caching import LRUCache
+
+try:
+    import fcntl
+except ImportError:
+    # No advisory file locks on Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_MEMORY_ENTRIES = 20_000
+DEFAULT_DISK_CAPACITY = 200_000
+FLUSH_EVERY = 256
+KEY_HASH_BYTES = 16
+
+
+def make_key(model_name: str, prefix: str, text: str) -> str:
+    """
+    Content address of an embedding: hash of the model name, the e5 prefix and the text.
+    """
+
+    digest = hashlib.blake2b(digest_size=20)
+    for part in (model_name, prefix, text):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _key_hash(key: str) -> bytes:
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=KEY_HASH_BYTES).digest()
+
+
+class StoreLocked(Exception):
+    """Raised when the directory of an on-disk store is in use by another process."""
+
+
+class DiskEmbeddingStore:
+    """
+    On-disk embedding tier: a memory-mapped float32 matrix, a parallel memory-mapped array with
+    the hash of each row's key, and a JSON index from key to row.
+
+    Rows are used as a ring buffer, so when the store is full the oldest embedding is overwritten.
+    The index is written every ``FLUSH_EVERY`` insertions and at interpreter exit, so after a crash it
+    may still point evicted keys at overwritten rows; a row is only returned if its stored key hash
+    matches the key. The directory is locked, so a second process fails with StoreLocked instead of
+    overwriting rows behind the first one's index.
+    """
+
+    def __init__(self, path: str, capacity: int = DEFAULT_DISK_CAPACITY):
+        self.path = path
+        self.capacity = capacity
+        self.evictions = 0
+        self._index_path = os.path.join(path, "index.json")
+        self._matrix_path = os.path.join(path, "embeddings.f32")
+        self._keys_path = os.path.join(path, "keys.bin")
+        self._matrix = None
+        self._keys = None
+        self._dim = None
+        self._rows = {}
+        self._row_keys = [None] * capacity
+        self._next_row = 0
+        self._dirty = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(path, exist_ok=True)
+        self._lock_file = self._lock_directory()
+        if all(os.path.exists(p) for p in (self._index_path, self._matrix_path, self._keys_path)):
+            with open(self._index_path, "r") as f:
+                index = json.load(f)
+            if index["capacity"] == capacity:
+                self._dim = index["dim"]
+                self._next_row = index["next_row"]
+                self._rows = index["rows"]
+                for key, row in self._rows.items():
+                    self._row_keys[row] = key
+                self._matrix = np.memmap(self._matrix_path, dtype=np.float32, mode="r+", shape=(capacity, self._dim))
+                self._keys = np.memmap(self._keys_path, dtype=np.uint8, mode="r+", shape=(capacity, KEY_HASH_BYTES))
+
+    def _lock_directory(self):
+        lock_file = open(os.path.join(self.path, "lock"), "w")
+        if fcntl is None:
+            return lock_file
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            raise StoreLocked(f"{self.path} is used by another process")
+        return lock_file
+
+    def _ensure_matrix(self, dim: int):
+        if self._matrix is None:
+            self._dim = dim
+            self._matrix = np.memmap(self._matrix_path, dtype=np.float32, mode="w+", shape=(self.capacity, dim))
+            self._keys = np.memmap(self._keys_path, dtype=np.uint8, mode="w+", shape=(self.capacity, KEY_HASH_BYTES))
+
+    def get(self, key: str) -> np.ndarray | None:
+        with self._lock:
+            row = self._rows.get(key)
+            if row is None:
+                return None
+            if self._keys[row].tobytes() != _key_hash(key):
+                # The row was reused for another key after the index was last written
+                del self._rows[key]
+                self._row_keys[row] = None
+                return None
+            return np.array(self._matrix[row])
+
+    def put(self, key: str, vector: np.ndarray):
+        with self._lock:
+            self._ensure_matrix(len(vector))
+            if key in self._rows:
+                return
+            row = self._next_row
+            old_key = self._row_keys[row]
+            if old_key is not None:
+                del self._rows[old_key]
+                self.evictions += 1
+            # The key hash goes first: if the process dies between the two writes, the row matches neither key
+            self._keys[row] = np.frombuffer(_key_hash(key), dtype=np.uint8)
+            self._matrix[row] = vector
+            self._rows[key] = row
+            self._row_keys[row] = key
+            self._next_row = (row + 1) % self.capacity
+            self._dirty += 1
+            if self._dirty >= FLUSH_EVERY:
+                self._flush_locked()
+
+    def _flush_locked(self):
+        if self._matrix is None or not self._dirty:
+            return
+        self._matrix.flush()
+        self._keys.flush()
+        tmp_path = self._index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"dim": self._dim, "capacity": self.capacity, "next_row": self._next_row, "rows": self._rows}, f)
+        os.replace(tmp_path, self._index_path)
+        self._dirty = 0
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def __len__(self):
+        return len(self._rows)
+
+
+class EmbeddingCache:
+    """
+    Two-tier embedding cache: an in-memory LRU in front of an optional on-disk store.
+
+    :param max_entries: Size of the in-memory tier.
+    :param disk_path: Directory of the on-disk tier; the tier is disabled if None.
+    :param disk_capacity: Maximum number of embeddings kept on disk.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MEMORY_ENTRIES, disk_path: str | None = None,
+                 disk_capacity: int = DEFAULT_DISK_CAPACITY):
+        self.memory = LRUCache(max_entries)
+        self.disk = None
+        if disk_path:
+            try:
+                self.disk = DiskEmbeddingStore(disk_path, disk_capacity)
+            except StoreLocked as e:
+                logger.warning("On-disk embedding cache disabled: %s", e)
+        self.disk_hits = 0
+        if self.disk is not None:
+            atexit.register(self.disk.flush)
+
+    def get(self, key: str) -> np.ndarray | None:
+        vector = self.memory.get(key)
+        if vector is None and self.disk is not None:
+            vector = self.disk.get(key)
+            if vector is not None:
+                self.disk_hits += 1
+                self.memory.put(key, vector)
+        return vector
+
+    def put(self, key: str, vector: np.ndarray):
+        self.memory.put(key, vector)
+        if self.disk is not None:
+            self.disk.put(key, vector)
+
+    def stats(self) -> dict:
+        memory = self.memory.stats()
+        stats = {
+            "memory_entries": memory["entries"],
+            "memory_evictions": memory["evictions"],
+            "hits": memory["hits"] + self.disk_hits,
+            "misses": memory["misses"] - self.disk_hits,
+            "disk_hits": self.disk_hits,
+        }
+        if self.disk is not None:
+            stats["disk_entries"] = len(self.disk)
+            stats["disk_evictions"] = self.disk.evictions
+        return stats
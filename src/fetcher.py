@@ -0,0 +1,228 @@
+import asyncio
+import contextlib
+import threading
+import time
+import weakref
+
+import httpx
+
+from urllib.parse import urlparse
+
+from content_extract import MAX_INPUT_BYTES, UnsupportedContent, is_binary_content_type, sniff_kind
+
+
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_READ_TIMEOUT = 10.0
+# Bytes of HTML beyond what the extractor parses are not worth downloading
+DEFAULT_MAX_BYTES = MAX_INPUT_BYTES
+DEFAULT_MAX_PDF_BYTES = 2 * 1024 * 1024
+DEFAULT_PER_HOST_LIMIT = 4
+DEFAULT_MAX_CONNECTIONS = 64
+DEFAULT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (compatible; AiDrivenSearchBot/1.0)",
+    "Accept": "text/html,application/xhtml+xml;q=0.9,*/*;q=0.8",
+}
+
+
+class FetchResult:
+    """
+    Result of a single page download.
+
+    :param url: Requested URL.
+    :param status_code: HTTP status code of the final response.
+    :param headers: Response headers.
+    :param content: Raw body, cut to the fetcher's byte limit.
+    :param encoding: Charset from the Content-Type header, None if not given.
+    :param kind: Sniffed body kind: "html" or "pdf".
+    :param truncated: True if the body was longer than the byte limit.
+    :param elapsed: Wall time of the request in seconds.
+    """
+
+    def __init__(self, url: str, status_code: int, headers: httpx.Headers, content: bytes, encoding: str | None,
+                 kind: str, truncated: bool, elapsed: float):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding
+        self.kind = kind
+        self.truncated = truncated
+        self.elapsed = elapsed
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(self.encoding or "utf-8", errors="replace")
+
+
+class AsyncFetcher:
+    """
+    Asynchronous page downloader with a shared connection pool.
+
+    Connections are reused between requests, the number of simultaneous requests
+    to one host is limited, and every body is read no further than ``max_bytes``.
+    Binary bodies (images, archives, media) and PDFs larger than ``max_pdf_bytes``
+    are rejected with UnsupportedContent as soon as their headers or first bytes arrive.
+    One fetcher must be used from a single event loop.
+    """
+
+    def __init__(self,
+                 per_host_limit: int = DEFAULT_PER_HOST_LIMIT,
+                 max_connections: int = DEFAULT_MAX_CONNECTIONS,
+                 connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout: float = DEFAULT_READ_TIMEOUT,
+                 max_bytes: int = DEFAULT_MAX_BYTES,
+                 max_pdf_bytes: int = DEFAULT_MAX_PDF_BYTES,
+                 headers: dict | None = None):
+        self.per_host_limit = per_host_limit
+        self.max_connections = max_connections
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.max_bytes = max_bytes
+        self.max_pdf_bytes = max_pdf_bytes
+        self.headers = {**DEFAULT_HEADERS, **(headers or {})}
+        self._client = None
+        # Host -> [semaphore, requests holding or waiting for it]; dropped when the count is back to 0
+        self._host_semaphores = {}
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections),
+                timeout=self.timeout,
+                headers=self.headers,
+                follow_redirects=True,
+            )
+        return self._client
+
+    @contextlib.asynccontextmanager
+    async def _host_slot(self, url: str):
+        host = urlparse(url).netloc.lower()
+        entry = self._host_semaphores.get(host)
+        if entry is None:
+            entry = self._host_semaphores[host] = [asyncio.Semaphore(self.per_host_limit), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._host_semaphores[host]
+
+    async def fetch(self, url: str, headers: dict | None = None) -> FetchResult:
+        """
+        Downloads a single URL. An exception raised by the download carries the seconds until
+        the failure in ``elapsed``, timed like FetchResult.elapsed.
+
+        :param url: The URL to download.
+        :param headers: Extra request headers.
+        :return: FetchResult with the (possibly truncated) body.
+        :raises httpx.HTTPError: On connection errors and timeouts.
+        :raises UnsupportedContent: For binary bodies and too large PDFs.
+        """
+
+        client = self._get_client()
+        async with self._host_slot(url):
+            start = time.perf_counter()
+            try:
+                async with client.stream("GET", url, headers=headers) as response:
+                    content_type = response.headers.get("Content-Type", "")
+                    if is_binary_content_type(content_type):
+                        raise UnsupportedContent(f"{url} has binary content type {content_type}")
+
+                    chunks = []
+                    size = 0
+                    truncated = False
+                    kind = None
+                    limit = self.max_bytes
+                    async for chunk in response.aiter_bytes():
+                        if kind is None:
+                            kind = sniff_kind(content_type, chunk[:16])
+                            if kind == "binary":
+                                raise UnsupportedContent(f"{url} has binary content")
+                            if kind == "pdf":
+                                limit = self.max_pdf_bytes
+                        chunks.append(chunk)
+                        size += len(chunk)
+                        if size > limit:
+                            if kind == "pdf":
+                                raise UnsupportedContent(f"{url} is a PDF larger than {self.max_pdf_bytes} bytes")
+                            truncated = True
+                            break
+                    content = b"".join(chunks)[:limit]
+            except Exception as e:
+                # From after the per-host wait, like a success, so the domain statistics compare the two
+                e.elapsed = time.perf_counter() - start
+                raise
+            return FetchResult(url, response.status_code, response.headers, content,
+                               response.charset_encoding, kind or "html", truncated,
+                               time.perf_counter() - start)
+
+    async def _fetch_or_error(self, url: str) -> tuple[str, FetchResult | Exception]:
+        try:
+            return url, await self.fetch(url)
+        except Exception as e:
+            return url, e
+
+    async def fetch_many(self, urls: list[str]):
+        """
+        Downloads several URLs concurrently and yields results as they complete.
+
+        Errors are yielded instead of raised so that one bad URL does not stop the rest.
+
+        :param urls: URLs to download.
+        :return: Async iterator of (url, FetchResult or Exception) tuples.
+        """
+
+        tasks = [asyncio.ensure_future(self._fetch_or_error(url)) for url in urls]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+_fetchers = weakref.WeakKeyDictionary()
+
+
+def get_fetcher() -> AsyncFetcher:
+    """
+    Returns the shared fetcher of the running event loop, creating it on first use.
+    """
+
+    loop = asyncio.get_running_loop()
+    fetcher = _fetchers.get(loop)
+    if fetcher is None:
+        fetcher = AsyncFetcher()
+        _fetchers[loop] = fetcher
+    return fetcher
+
+
+_sync_loop = None
+_sync_loop_lock = threading.Lock()
+
+
+def _get_sync_loop() -> asyncio.AbstractEventLoop:
+    global _sync_loop
+    with _sync_loop_lock:
+        if _sync_loop is None:
+            _sync_loop = asyncio.new_event_loop()
+            threading.Thread(target=_sync_loop.run_forever, name="fetcher-loop", daemon=True).start()
+    return _sync_loop
+
+
+def run_sync(coro):
+    """
+    Runs a coroutine on the fetcher's background event loop and waits for its result.
+
+    The loop lives for the whole process, so synchronous callers share one
+    connection pool instead of opening a new connection per request.
+    """
+
+    return asyncio.run_coroutine_threadsafe(coro, _get_sync_loop()).result()
@@ -0,0 +1,139 @@
+import os
+import queue
+import threading
+import time
+import logging
+
+import numpy as np
+
+from concurrent.futures import Future
+
+from models import get_cross_encoder, get_bi_encoder
+
+logger = logging.getLogger(__name__)
+
+MIN_BATCH_SIZE = 16
+MAX_BATCH_SIZE = 128
+
+
+def auto_batch_size() -> int:
+    """Batch size for the host: larger batches on machines with more cores."""
+    cpus = os.cpu_count() or 1
+    return max(MIN_BATCH_SIZE, min(MAX_BATCH_SIZE, 8 * cpus))
+
+
+DEFAULT_MAX_BATCH = int(os.getenv("INFERENCE_MAX_BATCH", 0)) or auto_batch_size()
+DEFAULT_MAX_WAIT = float(os.getenv("INFERENCE_MAX_WAIT_MS", 5)) / 1000
+
+ENCODE = "encode"
+PREDICT = "predict"
+
+
+class _Request:
+    def __init__(self, kind: str, items: list):
+        self.kind = kind
+        self.items = items
+        self.future = Future()
+
+
+class InferenceService:
+    """
+    Owns the cross-encoder and the bi-encoder and runs them on one worker thread.
+
+    Calls from all in-flight requests are put on a queue; the worker takes the first pending call,
+    keeps collecting more for up to ``max_wait`` seconds or until ``max_batch`` items are pending,
+    and then runs one model call per kind for the whole group, splitting the results back.
+
+    :param max_batch: Number of pending items after which a batch is started without waiting.
+    :param max_wait: Longest time in seconds a call waits for others to join its batch.
+    """
+
+    def __init__(self, max_batch: int = DEFAULT_MAX_BATCH, max_wait: float = DEFAULT_MAX_WAIT):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.batches = 0
+        self.requests = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._worker, name="inference", daemon=True)
+                self._thread.start()
+
+    def _submit(self, kind: str, items: list) -> np.ndarray:
+        if not items:
+            return np.array([])
+        self._ensure_started()
+        request = _Request(kind, items)
+        self._queue.put(request)
+        return request.future.result()
+
+    def encode(self, texts: list[str]) -> np.ndarray:
+        """Bi-encoder embeddings of already prefixed texts."""
+        return self._submit(ENCODE, list(texts))
+
+    def predict(self, pairs: list[tuple[str, str]]) -> np.ndarray:
+        """Cross-encoder scores of (query, passage) pairs."""
+        return self._submit(PREDICT, list(pairs))
+
+    def _collect(self) -> list[_Request]:
+        pending = [self._queue.get()]
+        size = len(pending[0].items)
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            pending.append(request)
+            size += len(request.items)
+        return pending
+
+    def _run(self, kind: str, items: list) -> np.ndarray:
+        if kind == ENCODE:
+            return get_bi_encoder().encode(items, batch_size=self.max_batch, show_progress_bar=False)
+        # Sort by passage length so every batch has little padding
+        order = sorted(range(len(items)), key=lambda i: len(items[i][1]))
+        predicted = get_cross_encoder().predict([items[i] for i in order], batch_size=self.max_batch,
+                                                show_progress_bar=False)
+        scores = np.empty(len(items), dtype=np.float32)
+        scores[order] = predicted
+        return scores
+
+    def _worker(self):
+        while True:
+            pending = self._collect()
+            for kind in (ENCODE, PREDICT):
+                group = [request for request in pending if request.kind == kind]
+                if not group:
+                    continue
+                items = [item for request in group for item in request.items]
+                try:
+                    results = self._run(kind, items)
+                except Exception as e:
+                    logger.exception("Inference batch failed")
+                    for request in group:
+                        request.future.set_exception(e)
+                    continue
+                self.batches += 1
+                self.requests += len(group)
+                offset = 0
+                for request in group:
+                    request.future.set_result(results[offset:offset + len(request.items)])
+                    offset += len(request.items)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "requests": self.requests,
+            "queued": self._queue.qsize(),
+        }
+
+
+service = InferenceService()
@@ -1,36 +1,35 @@
-from paraphrase import paraphrase_query
-from web_search import search_web
-from reranker import rerank_documents
-from answer_generator import generate_answer
+import logging
 
-def ai_overview_pipeline(user_query, history=None):
-    print("🔁 Перефразировка запроса...")
-    refined = paraphrase_query(user_query, history)
-    print("📝 Перефразированный запрос:", refined)
-    
-    print("🌐 Веб-поиск...")
-    raw_docs = search_web(refined)
-    print("🔍 Результаты поиска:", raw_docs)
-    
-    print("📊 Реранкинг...")
-    top_docs = rerank_documents(refined, raw_docs)
-    print("📄 Топ-результаты:", top_docs)
-    
-    print("🤖 Генерация ответа...")
-    answer = generate_answer(user_query, top_docs, history)
-    print("📝 Ответ:", answer)
+from pipeline import RetrievalPipeline
+from session import ConversationSession
+
+logger = logging.getLogger(__name__)
 
-    return answer
+pipeline = RetrievalPipeline()
+
+def ai_overview_pipeline(user_query, session=None):
+    result = pipeline.run_sync(user_query, session=session)
+    if result.reused:
+        logger.info("Follow-up answered from the previous turn's pages")
+    logger.info("Paraphrases: %s", result.paraphrases)
+    logger.info("Sources: %s", [document.url for document in result.documents])
+    logger.info("Timings: %s", {stage: round(seconds, 2) for stage, seconds in result.timings.items()})
+    if result.cached is not None:
+        logger.info("Answer cached for %r (similarity %.3f)", result.cached.query, result.cached.similarity)
+    logger.info("Chunk cascade: %s", result.cascade.as_dict())
+    if result.over_budget:
+        logger.info("Stages over budget: %s", result.over_budget)
+
+    return result.answer
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
     
-    history = []
+    session = ConversationSession()
     while True:
         print("\n\n====================\n")
         q = input("Введите ваш вопрос: ")
-        res = ai_overview_pipeline(q, history)
-        history.append("Пользователь: " + q)
-        history.append("AI-агент: " + res)
+        print("🔁 Перефразировка запроса, веб-поиск и реранкинг...")
+        res = ai_overview_pipeline(q, session)
         
         print("\n📝 Ответ:\n", res)
-
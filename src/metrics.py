@@ -0,0 +1,190 @@
+import os
+import time
+import bisect
+import threading
+import http.server
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+PREFIX = "aids_"
+
+_enabled = os.getenv("METRICS_ENABLED", "").lower() in ("1", "true", "yes")
+
+
+def enable(value: bool = True):
+    """Turns collection on or off; while off every call below returns immediately."""
+    global _enabled
+    _enabled = value
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(key: tuple, extra: tuple = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = PREFIX + name
+        self.help = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(_label_key(labels), 0)
+
+    def export(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            lines += [f"{self.name}{_format_labels(key)} {value}" for key, value in sorted(self._values.items())]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = PREFIX + name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def export(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{self.name}_bucket{_format_labels(key, (('le', le),))} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+span_seconds = Histogram("span_seconds", "Duration of pipeline operations in seconds")
+cache_hits = Counter("cache_hits_total", "Cache hits by cache")
+cache_misses = Counter("cache_misses_total", "Cache misses by cache")
+fetch_failures = Counter("fetch_failures_total", "Failed page downloads by reason")
+hedged_requests = Counter("hedged_requests_total", "Search calls sent a second time because the first was slow")
+
+_metrics = [span_seconds, cache_hits, cache_misses, fetch_failures, hedged_requests]
+
+
+class _Span:
+    __slots__ = ("name", "labels", "start")
+
+    def __init__(self, name: str, labels: dict):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        span_seconds.observe(time.perf_counter() - self.start, span=self.name,
+                             status="ok" if exc_type is None else "error", **self.labels)
+        return False
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def span(name: str, **labels):
+    """
+    Context manager that records how long its block took in the span_seconds histogram.
+
+    :param name: Operation name, e.g. "fetch" or "mmr".
+    :param labels: Extra labels, e.g. engine="Google". Keep their values low-cardinality.
+    """
+
+    if not _enabled:
+        return _NOOP_SPAN
+    return _Span(name, labels)
+
+
+def cache_hit(cache: str, hits: int = 1):
+    if _enabled and hits:
+        cache_hits.inc(hits, cache=cache)
+
+
+def cache_miss(cache: str, misses: int = 1):
+    if _enabled and misses:
+        cache_misses.inc(misses, cache=cache)
+
+
+def fetch_failure(reason: str):
+    if _enabled:
+        fetch_failures.inc(reason=reason)
+
+
+def hedged_request(engine: str):
+    if _enabled:
+        hedged_requests.inc(engine=engine)
+
+
+def export_text() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    return "\n".join(line for metric in _metrics for line in metric.export()) + "\n"
+
+
+def start_http_server(port: int, host: str = "0.0.0.0") -> http.server.ThreadingHTTPServer:
+    """
+    Enables collection and serves export_text() at /metrics from a daemon thread.
+    """
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = export_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    enable()
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
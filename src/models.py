@@ -1,19 +1,155 @@
 import os
+import time
+import logging
+import threading
+
+from concurrent.futures import Future, ThreadPoolExecutor
 from dotenv import load_dotenv
-from langchain_community.llms import GigaChat
-from sentence_transformers import CrossEncoder, SentenceTransformer
 
 load_dotenv()
 
-# GigaChat LLM
-llm = GigaChat(
-    credentials=os.getenv("GIGACHAT_CREDENTIALS_PATH"),
-    verify_ssl_certs=False,
-    model="GigaChat:latest"
-)
+logger = logging.getLogger(__name__)
+
+CROSS_ENCODER_NAME = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+BI_ENCODER_NAME = "intfloat/multilingual-e5-base"
+
+# "torch" (default), "onnx" or "onnx-int8" (ONNX Runtime with int8 dynamic quantization)
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "torch")
+
+
+def response_text(response) -> str:
+    """Text of an LLM response or streamed chunk: completion LLMs return strings, chat models return messages."""
+    return getattr(response, "content", response)
+
+
+def _load_llm():
+    from langchain_community.llms import GigaChat
+
+    # GigaChat LLM
+    return GigaChat(
+        credentials=os.getenv("GIGACHAT_CREDENTIALS_PATH"),
+        verify_ssl_certs=False,
+        model="GigaChat:latest"
+    )
+
+
+def _load_cross_encoder():
+    if INFERENCE_BACKEND.startswith("onnx"):
+        import onnx_backend
+
+        return onnx_backend.load_cross_encoder(CROSS_ENCODER_NAME, quantize=INFERENCE_BACKEND == "onnx-int8")
+
+    from sentence_transformers import CrossEncoder
+
+    return CrossEncoder(CROSS_ENCODER_NAME)
+
+
+def _load_bi_encoder():
+    if INFERENCE_BACKEND.startswith("onnx"):
+        import onnx_backend
+
+        return onnx_backend.load_bi_encoder(BI_ENCODER_NAME, quantize=INFERENCE_BACKEND == "onnx-int8")
+
+    from sentence_transformers import SentenceTransformer
+
+    return SentenceTransformer(BI_ENCODER_NAME)
+
+
+class ModelRegistry:
+    """
+    Loads models lazily, on first use, and remembers how long each load took.
+
+    Each model is loaded at most once even when several threads ask for it at the same time.
+    """
+
+    def __init__(self):
+        self._loaders = {}
+        self._models = {}
+        self._locks = {}
+        self.load_times = {}
+
+    def register(self, name: str, loader):
+        self._loaders[name] = loader
+        self._locks[name] = threading.Lock()
+
+    def set(self, name: str, model):
+        """Replaces a model with an already built object, e.g. a stub in benchmarks."""
+        self._models[name] = model
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._models
+
+    def get(self, name: str):
+        model = self._models.get(name)
+        if model is not None:
+            return model
+        with self._locks[name]:
+            model = self._models.get(name)
+            if model is None:
+                start = time.perf_counter()
+                model = self._loaders[name]()
+                self.load_times[name] = time.perf_counter() - start
+                logger.info("Loaded model %s in %.2fs", name, self.load_times[name])
+                self._models[name] = model
+        return model
+
+    def warmup(self, names: list[str] | None = None, background: bool = True):
+        """
+        Loads the given models (all registered ones by default) in parallel.
+
+        :param names: Names of the models to load.
+        :param background: If True, returns immediately with a Future instead of waiting.
+        :return: Load times by model name, or a Future resolving to them if background is True.
+        """
+
+        names = names or list(self._loaders)
+        done = Future()
+
+        def _load_all():
+            with ThreadPoolExecutor(max_workers=len(names), thread_name_prefix="model-warmup") as executor:
+                futures = [executor.submit(self.get, name) for name in names]
+            errors = [future.exception() for future in futures if future.exception() is not None]
+            if errors:
+                done.set_exception(errors[0])
+            else:
+                done.set_result(dict(self.load_times))
+
+        if background:
+            threading.Thread(target=_load_all, name="model-warmup", daemon=True).start()
+            return done
+        _load_all()
+        return done.result()
+
+
+registry = ModelRegistry()
+registry.register("llm", _load_llm)
+registry.register("cross_encoder", _load_cross_encoder)
+registry.register("bi_encoder", _load_bi_encoder)
+
+
+def get_llm():
+    return registry.get("llm")
+
+
+def get_cross_encoder():
+    return registry.get("cross_encoder")
+
+
+def get_bi_encoder():
+    return registry.get("bi_encoder")
+
+
+def warmup(names: list[str] | None = None, background: bool = True):
+    return registry.warmup(names, background)
+
+
+def load_times() -> dict:
+    """Seconds spent loading each model that has been loaded so far."""
+    return dict(registry.load_times)
 
-# CrossEncoder
-cross_encoder = CrossEncoder("cross-encoder/ms-marco-MiniLM-L-6-v2")
 
-#Bi-encoder
-bi_encoder = SentenceTransformer('intfloat/multilingual-e5-base')
\ No newline at end of file
+def __getattr__(name):
+    # Keeps `models.llm`, `models.cross_encoder` and `models.bi_encoder` working, loading on first access
+    if name in registry._loaders:
+        return registry.get(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
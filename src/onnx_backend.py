@@ -0,0 +1,155 @@
+import os
+import sys
+import logging
+
+import numpy as np
+
+from utils import cache_path
+
+logger = logging.getLogger(__name__)
+
+# One of "arm64", "avx2", "avx512", "avx512_vnni"; pick the newest instruction set the servers support
+QUANTIZATION_CONFIG = os.getenv("ONNX_QUANTIZATION_CONFIG", "avx2")
+ONNX_FILE = "onnx/model.onnx"
+
+
+def export_dir(model_name: str) -> str:
+    """Directory with the exported ONNX artifacts of a model."""
+    return cache_path("onnx", model_name.replace("/", "--"))
+
+
+def _quantized_file() -> str:
+    return f"onnx/model_qint8_{QUANTIZATION_CONFIG}.onnx"
+
+
+def _load(model_cls, model_name: str, quantize: bool):
+    path = export_dir(model_name)
+    if not os.path.exists(os.path.join(path, ONNX_FILE)):
+        logger.info("Exporting %s to ONNX in %s", model_name, path)
+        model_cls(model_name, backend="onnx").save_pretrained(path)
+
+    if not quantize:
+        return model_cls(path, backend="onnx")
+
+    if not os.path.exists(os.path.join(path, _quantized_file())):
+        from sentence_transformers import export_dynamic_quantized_onnx_model
+
+        logger.info("Quantizing %s to int8 (%s)", model_name, QUANTIZATION_CONFIG)
+        export_dynamic_quantized_onnx_model(model_cls(path, backend="onnx"), QUANTIZATION_CONFIG, path)
+    return model_cls(path, backend="onnx", model_kwargs={"file_name": _quantized_file()})
+
+
+def load_cross_encoder(model_name: str, quantize: bool = False):
+    """
+    Loads a cross-encoder on ONNX Runtime, exporting (and quantizing) it on first use.
+
+    :param model_name: Hugging Face model name.
+    :param quantize: Use int8 dynamic quantization.
+    """
+
+    from sentence_transformers import CrossEncoder
+
+    return _load(CrossEncoder, model_name, quantize)
+
+
+def load_bi_encoder(model_name: str, quantize: bool = False):
+    """
+    Loads a bi-encoder on ONNX Runtime, exporting (and quantizing) it on first use.
+
+    :param model_name: Hugging Face model name.
+    :param quantize: Use int8 dynamic quantization.
+    """
+
+    from sentence_transformers import SentenceTransformer
+
+    return _load(SentenceTransformer, model_name, quantize)
+
+
+def _spearman(a: np.ndarray, b: np.ndarray) -> float:
+    rank_a = np.argsort(np.argsort(a)).astype(np.float64)
+    rank_b = np.argsort(np.argsort(b)).astype(np.float64)
+    if rank_a.std() == 0 or rank_b.std() == 0:
+        return 1.0
+    return float(np.corrcoef(rank_a, rank_b)[0, 1])
+
+
+def _compare(reference: list[np.ndarray], candidate: list[np.ndarray], top_k: int) -> dict:
+    spearman = [_spearman(r, c) for r, c in zip(reference, candidate)]
+    overlap = [len(set(np.argsort(-r)[:top_k]) & set(np.argsort(-c)[:top_k])) / min(top_k, len(r))
+               for r, c in zip(reference, candidate)]
+    return {
+        "mean_spearman": float(np.mean(spearman)),
+        "min_spearman": float(np.min(spearman)),
+        "mean_top_k_overlap": float(np.mean(overlap)),
+        "min_top_k_overlap": float(np.min(overlap)),
+    }
+
+
+def parity_check(queries: list[str], passages: list[str], backend: str = "onnx-int8", top_k: int = 5) -> dict:
+    """
+    Compares the rankings produced by an ONNX backend with the PyTorch models.
+
+    Every query ranks all passages with the cross-encoder and with the bi-encoder (cosine similarity),
+    once per backend; the report gives Spearman correlation and top-k overlap of the rankings.
+
+    :param queries: Queries to rank passages for.
+    :param passages: Candidate passages.
+    :param backend: "onnx" or "onnx-int8".
+    :param top_k: Size of the top used for the overlap metric.
+    :return: Metrics for the cross-encoder and the bi-encoder.
+    """
+
+    from sentence_transformers import CrossEncoder, SentenceTransformer
+    from models import CROSS_ENCODER_NAME, BI_ENCODER_NAME
+
+    quantize = backend == "onnx-int8"
+    pairs = [[(query, passage) for passage in passages] for query in queries]
+
+    def cross_scores(model):
+        return [np.asarray(model.predict(query_pairs, show_progress_bar=False)) for query_pairs in pairs]
+
+    def bi_scores(model):
+        query_embeddings = model.encode(["query: " + q for q in queries], normalize_embeddings=True)
+        passage_embeddings = model.encode(["passage: " + p for p in passages], normalize_embeddings=True)
+        return list(query_embeddings @ passage_embeddings.T)
+
+    return {
+        "cross_encoder": _compare(cross_scores(CrossEncoder(CROSS_ENCODER_NAME)),
+                                  cross_scores(load_cross_encoder(CROSS_ENCODER_NAME, quantize)), top_k),
+        "bi_encoder": _compare(bi_scores(SentenceTransformer(BI_ENCODER_NAME)),
+                               bi_scores(load_bi_encoder(BI_ENCODER_NAME, quantize)), top_k),
+    }
+
+
+SAMPLE_QUERIES = [
+    "что такое искусственный интеллект",
+    "как изучать python с нуля",
+    "рецепт борща с пошаговыми инструкциями",
+    "history of the Apple company",
+]
+
+SAMPLE_PASSAGES = [
+    "Искусственный интеллект — свойство систем выполнять творческие функции, которые традиционно считаются прерогативой человека.",
+    "Машинное обучение — класс методов искусственного интеллекта, обучающихся на данных.",
+    "Python — высокоуровневый язык программирования общего назначения с динамической типизацией.",
+    "Для начинающих лучше всего подойдут бесплатные курсы по Python и официальная документация.",
+    "Борщ варят на мясном бульоне со свёклой, капустой, картофелем и томатной пастой.",
+    "Сначала отварите говядину, затем добавьте нарезанные овощи и варите до готовности.",
+    "Apple was founded by Steve Jobs, Steve Wozniak and Ronald Wayne in April 1976.",
+    "The iPhone was introduced by Apple in 2007 and changed the smartphone market.",
+    "Яблоки содержат клетчатку, витамин C и антиоксиданты.",
+    "Погода в Москве завтра будет облачной с прояснениями.",
+]
+
+MIN_SPEARMAN = 0.9
+MIN_TOP_K_OVERLAP = 0.8
+
+if __name__ == "__main__":
+    backend = sys.argv[1] if len(sys.argv) > 1 else "onnx-int8"
+    report = parity_check(SAMPLE_QUERIES, SAMPLE_PASSAGES, backend=backend, top_k=3)
+    ok = True
+    for model, metrics in report.items():
+        print(model, {name: round(value, 4) for name, value in metrics.items()})
+        ok = ok and metrics["min_spearman"] >= MIN_SPEARMAN and metrics["min_top_k_overlap"] >= MIN_TOP_K_OVERLAP
+    print("Parity OK" if ok else "Parity check FAILED")
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,217 @@
+import os
+import sqlite3
+import threading
+import time
+
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+
+DEFAULT_TTL = 3600
+DEFAULT_NEGATIVE_TTL = 300
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+# Access times are written in batches of this many; they only order evictions
+ACCESS_BATCH = 64
+TRACKING_PARAMS = ("utm_", "yclid", "gclid", "fbclid")
+
+
+def normalize_url(url: str) -> str:
+    """
+    Canonical form of a URL used as the cache key.
+
+    Lowercases the scheme and host, drops default ports, fragments and tracking parameters,
+    and sorts the query string.
+    """
+
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and (scheme, parts.port) not in (("http", 80), ("https", 443)):
+        host = f"{host}:{parts.port}"
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+                   if not k.lower().startswith(TRACKING_PARAMS))
+    return urlunsplit((scheme, host, parts.path or "/", urlencode(query), ""))
+
+
+class CacheEntry:
+    """
+    A cached page, or a cached failure when ``error`` is set.
+    """
+
+    def __init__(self, url: str, status_code: int | None, markdown: str | None, error: str | None,
+                 etag: str | None, last_modified: str | None, expires_at: float):
+        self.url = url
+        self.status_code = status_code
+        self.markdown = markdown
+        self.error = error
+        self.etag = etag
+        self.last_modified = last_modified
+        self.expires_at = expires_at
+
+    @property
+    def is_negative(self) -> bool:
+        return self.error is not None
+
+    def is_fresh(self) -> bool:
+        return time.time() < self.expires_at
+
+    def validators(self) -> dict:
+        """Headers for a conditional request revalidating this entry."""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class PageCache:
+    """
+    On-disk cache of converted pages keyed by normalized URL.
+
+    Stored in SQLite in WAL mode, so several bot worker processes on one host can share it.
+    Successful pages live for ``ttl`` seconds and are then revalidated with ETag / Last-Modified;
+    failures (HTTP errors, timeouts) are cached for ``negative_ttl`` seconds. When the stored
+    markdown exceeds ``max_bytes`` the least recently accessed pages are evicted.
+
+    The methods block on SQLite, so async code calls them in a thread. The stored size is tracked
+    as a running total, recounted only when it crosses ``max_bytes`` (other processes add to it too),
+    and access times are written every ``ACCESS_BATCH`` reads and before evicting.
+    """
+
+    def __init__(self, path: str, ttl: float = DEFAULT_TTL, negative_ttl: float = DEFAULT_NEGATIVE_TTL,
+                 max_bytes: int = DEFAULT_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._accessed = {}
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connection() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS pages (
+                    url TEXT PRIMARY KEY,
+                    status_code INTEGER,
+                    markdown TEXT,
+                    error TEXT,
+                    etag TEXT,
+                    last_modified TEXT,
+                    expires_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL,
+                    size INTEGER NOT NULL
+                )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS pages_accessed_at ON pages (accessed_at)")
+            self._total = self._stored_bytes(conn)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, url: str) -> CacheEntry | None:
+        """
+        Returns the entry for a URL, fresh or expired, or None if the URL was never cached.
+        """
+
+        key = normalize_url(url)
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT status_code, markdown, error, etag, last_modified, expires_at FROM pages WHERE url = ?",
+            (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self._touch(key)
+        entry = CacheEntry(key, *row)
+        if entry.is_fresh():
+            self.hits += 1
+        else:
+            self.misses += 1
+        return entry
+
+    def put(self, url: str, markdown: str, etag: str | None = None, last_modified: str | None = None,
+            status_code: int = 200):
+        self._store(url, status_code, markdown, None, etag, last_modified, self.ttl)
+
+    def put_negative(self, url: str, error: str, status_code: int | None = None):
+        self._store(url, status_code, None, error, None, None, self.negative_ttl)
+
+    def revalidated(self, url: str):
+        """Marks an expired entry as confirmed unchanged by the server (HTTP 304)."""
+        self.revalidations += 1
+        now = time.time()
+        self._connection().execute("UPDATE pages SET expires_at = ?, accessed_at = ? WHERE url = ?",
+                                   (now + self.ttl, now, normalize_url(url)))
+
+    def _touch(self, key: str):
+        with self._lock:
+            self._accessed[key] = time.time()
+            if len(self._accessed) < ACCESS_BATCH:
+                return
+        self._write_accessed(self._connection())
+
+    def _write_accessed(self, conn: sqlite3.Connection):
+        with self._lock:
+            accessed, self._accessed = self._accessed, {}
+        if accessed:
+            conn.executemany("UPDATE pages SET accessed_at = ? WHERE url = ?",
+                             [(at, key) for key, at in accessed.items()])
+
+    @staticmethod
+    def _stored_bytes(conn: sqlite3.Connection) -> int:
+        return conn.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+
+    def _store(self, url, status_code, markdown, error, etag, last_modified, ttl):
+        now = time.time()
+        key = normalize_url(url)
+        size = len(markdown.encode("utf-8")) if markdown else 0
+        conn = self._connection()
+        old = conn.execute("SELECT size FROM pages WHERE url = ?", (key,)).fetchone()
+        conn.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                     (key, status_code, markdown, error, etag, last_modified, now + ttl, now, size))
+        with self._lock:
+            self._total += size - (old[0] if old else 0)
+            over = self._total > self.max_bytes
+        if over:
+            self._evict(conn)
+
+    def _evict(self, conn: sqlite3.Connection):
+        self._write_accessed(conn)
+        total = self._stored_bytes(conn)
+        if total <= self.max_bytes:
+            with self._lock:
+                self._total = total
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            freed = 0
+            for key, size in conn.execute("SELECT url, size FROM pages ORDER BY accessed_at").fetchall():
+                if total - freed <= self.max_bytes:
+                    break
+                conn.execute("DELETE FROM pages WHERE url = ?", (key,))
+                freed += size
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        with self._lock:
+            self._total = total - freed
+
+    def stats(self) -> dict:
+        entries, total = self._connection().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM pages").fetchone()
+        return {
+            "entries": entries,
+            "bytes": total,
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidations": self.revalidations,
+        }
@@ -1,6 +1,15 @@
 from langchain.prompts import ChatPromptTemplate, FewShotChatMessagePromptTemplate, SystemMessagePromptTemplate, HumanMessagePromptTemplate
-from langchain.chains import LLMChain
-from models import llm
+from langchain_core.runnables import Runnable
+from models import get_llm, response_text
+from session import format_history
+from caching import LRUCache
+from web_search import normalize_query
+from functools import lru_cache
+import metrics
+import asyncio
+import contextlib
+import threading
+import os
 import re
 import enum
 
@@ -15,21 +24,22 @@ class ParaphaseMode(enum.Enum):
     SIMPLIFY = 0
 
 
-def paraphrase_query(query : str, mode : ParaphaseMode = ParaphaseMode.SIMPLIFY) -> list[str]:
+PARAPHRASE_CACHE_SIZE = int(os.getenv("PARAPHRASE_CACHE_SIZE", 10_000))
+PARAPHRASE_CACHE_TTL = float(os.getenv("PARAPHRASE_CACHE_TTL", 24 * 3600))
+
+# Перефразировки по (нормализованный запрос вместе с историей диалога, режим)
+paraphrase_cache = LRUCache(PARAPHRASE_CACHE_SIZE, ttl=PARAPHRASE_CACHE_TTL)
+
+_chains = {}
+_chains_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def _build_prompt(mode : ParaphaseMode) -> ChatPromptTemplate:
     """
-    Функция для перефразировки поискового запроса с использованием LLM.
-    Возвращает несколько вариантов перефразированного запроса.
-    
-    :param query: Исходный поисковый запрос
-    :param mode: Режим перефразировки (EXPAND или SIMPLIFY)
-    
-    :return: Строка с перефразированными запросами
-    :raises AssertionError: Если входные данные не соответствуют ожиданиям
+    Собирает few-shot промпт режима. Примеры и шаблоны не меняются, поэтому промпт строится один раз на режим.
     """
     
-    assert isinstance(query, str), "Query must be a string"
-    assert isinstance(mode, ParaphaseMode), "mode must be an instance of ParaphaseMode"
-    
     if mode == ParaphaseMode.EXPAND:
         examples = [
         {
@@ -81,6 +91,7 @@ def paraphrase_query(query : str, mode : ParaphaseMode = ParaphaseMode.SIMPLIFY)
 - Запросы должны сохранять смысл, но освещать разные возможные направления уточнения.
 - При коротких или неясных запросах — обязательно дополни их для лучшего понимания сути.
 - Следи, чтобы дополнения не искажали исходный смысл.
+- Если перед запросом дан предыдущий диалог, сделай запрос самостоятельным: подставь из диалога то, о чём идёт речь.
 - Стиль формулировок должен оставаться естественным и подходящим для поиска в интернете.
 Формат:
 - Пронумерованный список.
@@ -125,6 +136,7 @@ def paraphrase_query(query : str, mode : ParaphaseMode = ParaphaseMode.SIMPLIFY)
 - Напиши только 1 вариант перефразировки.
 - При коротких или неясных запросах — обязательно дополни их для лучшего понимания сути.
 - Следи, чтобы дополнения не искажали исходный смысл.
+- Если перед запросом дан предыдущий диалог, сделай запрос самостоятельным: подставь из диалога то, о чём идёт речь.
 - Стиль формулировок должен оставаться естественным и подходящим для поиска в интернете.
 
 Формат:
@@ -142,16 +154,153 @@ def paraphrase_query(query : str, mode : ParaphaseMode = ParaphaseMode.SIMPLIFY)
     ]
     )
     
-    chain = final_prompt | llm
-    
+    return final_prompt
+
+def _get_chain(mode : ParaphaseMode):
+    """
+    Цепочка промпт | LLM для режима, построенная один раз; пересобирается, только если LLM в реестре заменили.
+    """
     
-    response = chain.invoke({"input": query})
-    paraphrases = list(response.split('\n'))
+    llm = get_llm()
+    with _chains_lock:
+        cached = _chains.get(mode)
+        if cached is None or cached[0] is not llm:
+            cached = _chains[mode] = (llm, _build_prompt(mode) | llm)
+        return cached[1]
+
+def _cache_key(query : str, mode : ParaphaseMode, history : list[str] | None = None) -> tuple:
+    # С историей ключ — весь вход промпта: тот же вопрос в другом диалоге значит другое
+    return normalize_query(_with_history(query, history)), mode.name
+
+def _parse(response) -> list[str]:
+    text = response_text(response)
+    paraphrases = list(text.split('\n'))
     paraphrases = [p for p in paraphrases if len(p) > 0 and p[0].isdigit()]
     paraphrases = [re.sub(r'^\s*\d+[\.\-\)]\s*', '', p) for p in paraphrases]
+    return paraphrases
+
+def cached_paraphrases(query : str, mode : ParaphaseMode, history : list[str] | None = None) -> list[str] | None:
+    """
+    Перефразировки запроса из кэша, без обращения к LLM; None, если их там нет.
+    """
+    
+    paraphrases = paraphrase_cache.get(_cache_key(query, mode, history))
+    if paraphrases is None:
+        return None
+    metrics.cache_hit("paraphrase")
+    return list(paraphrases)
+
+def _remember(query : str, mode : ParaphaseMode, history : list[str] | None, paraphrases : list[str]):
+    # Пустой ответ не кэшируем: это скорее сбой LLM, чем результат
+    if paraphrases:
+        paraphrase_cache.put(_cache_key(query, mode, history), list(paraphrases))
+
+def paraphrase_query(query : str, mode : ParaphaseMode = ParaphaseMode.SIMPLIFY, history : list[str] | None = None) -> list[str]:
+    """
+    Функция для перефразировки поискового запроса с использованием LLM.
+    Возвращает несколько вариантов перефразированного запроса.
+    Одинаковые (после нормализации) запросы в пределах TTL отдаются из кэша без обращения к LLM.
+    
+    :param query: Исходный поисковый запрос
+    :param mode: Режим перефразировки (EXPAND или SIMPLIFY)
+    :param history: Предыдущие реплики диалога; с ними уточняющий вопрос превращается в самостоятельный запрос
+    
+    :return: Строка с перефразированными запросами
+    :raises AssertionError: Если входные данные не соответствуют ожиданиям
+    """
+    
+    assert isinstance(query, str), "Query must be a string"
+    assert isinstance(mode, ParaphaseMode), "mode must be an instance of ParaphaseMode"
+    
+    paraphrases = cached_paraphrases(query, mode, history)
+    if paraphrases is not None:
+        return paraphrases
+    metrics.cache_miss("paraphrase")
+    
+    with metrics.span("paraphrase", mode=mode.name):
+        response = _get_chain(mode).invoke({"input": _with_history(query, history)})
+    paraphrases = _parse(response)
+    _remember(query, mode, history, paraphrases)
     
     return paraphrases
 
+def _split_cached(queries, mode, histories):
+    histories = histories or [None] * len(queries)
+    assert len(histories) == len(queries), "histories must have one entry per query"
+    results = [cached_paraphrases(query, mode, history) for query, history in zip(queries, histories)]
+    # Одинаковые запросы (с одинаковой историей) отправляются в LLM один раз
+    pending = {}
+    for i, (query, history, result) in enumerate(zip(queries, histories, results)):
+        if result is None:
+            pending.setdefault(_cache_key(query, mode, history), []).append(i)
+    metrics.cache_miss("paraphrase", sum(len(positions) for positions in pending.values()))
+    inputs = [{"input": _with_history(queries[positions[0]], histories[positions[0]])} for positions in pending.values()]
+    return results, histories, pending, inputs
+
+def _merge(queries, mode, histories, results, pending, responses) -> list[list[str]]:
+    for positions, response in zip(pending.values(), responses):
+        first = positions[0]
+        paraphrases = [] if isinstance(response, Exception) else _parse(response)
+        _remember(queries[first], mode, histories[first], paraphrases)
+        for i in positions:
+            results[i] = list(paraphrases)
+    return results
+
+def paraphrase_many(queries : list[str], mode : ParaphaseMode = ParaphaseMode.SIMPLIFY,
+                    histories : list[list[str] | None] | None = None, max_concurrency : int | None = None) -> list[list[str]]:
+    """
+    Перефразирует сразу несколько запросов через batch-интерфейс LLM: запросы, которых нет в кэше,
+    отправляются параллельно, а не по одному.
+    
+    :param queries: Поисковые запросы
+    :param mode: Режим перефразировки (EXPAND или SIMPLIFY)
+    :param histories: История диалога для каждого запроса, если есть
+    :param max_concurrency: Сколько запросов к LLM выполняется одновременно; без ограничения, если None
+    
+    :return: Список перефразировок для каждого запроса, в том же порядке; пустой список, если запрос к LLM не удался
+    """
+    
+    results, histories, pending, inputs = _split_cached(queries, mode, histories)
+    if inputs:
+        with metrics.span("paraphrase", mode=mode.name, batch="sync"):
+            # Не chain.batch: у LLM-моделей (не чат) он отправляет промпты в _generate по одному,
+            # а базовый Runnable.batch вызывает цепочку для каждого запроса параллельно в потоках
+            responses = Runnable.batch(_get_chain(mode), inputs, config={"max_concurrency": max_concurrency},
+                                       return_exceptions=True)
+        results = _merge(queries, mode, histories, results, pending, responses)
+    return results
+
+async def aparaphrase_many(queries : list[str], mode : ParaphaseMode = ParaphaseMode.SIMPLIFY,
+                           histories : list[list[str] | None] | None = None, max_concurrency : int | None = None,
+                           limit : contextlib.AbstractAsyncContextManager | None = None) -> list[list[str]]:
+    """
+    То же, что paraphrase_many, но через асинхронный интерфейс LLM, не занимая потоки.
+    
+    :param limit: Общий для приложения лимит запросов к LLM (например, asyncio.Semaphore); каждый запрос
+        занимает его на время своего вызова, поэтому пакет не держит слоты, пока ждёт остальные
+    """
+    
+    results, histories, pending, inputs = _split_cached(queries, mode, histories)
+    if inputs:
+        if limit is None:
+            limit = asyncio.Semaphore(max_concurrency) if max_concurrency else contextlib.nullcontext()
+        chain = _get_chain(mode)
+        
+        async def invoke(prompt_input):
+            async with limit:
+                return await chain.ainvoke(prompt_input)
+        
+        with metrics.span("paraphrase", mode=mode.name, batch="async"):
+            # Запросы идут одновременно, как в Runnable.abatch (см. paraphrase_many)
+            responses = await asyncio.gather(*(invoke(prompt_input) for prompt_input in inputs), return_exceptions=True)
+        results = _merge(queries, mode, histories, results, pending, responses)
+    return results
+
+def _with_history(query, history):
+    if not history:
+        return query
+    return f"{format_history(history)}\n\nЗапрос: {query}"
+
 if __name__ == "__main__":
     query = "Как изучить тайм-менеджмент"
     paraphrased_queries = paraphrase_query(query, mode=ParaphaseMode.SIMPLIFY)
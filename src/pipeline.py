@@ -0,0 +1,567 @@
+import asyncio
+import contextlib
+import itertools
+import logging
+import math
+import os
+import threading
+import time
+
+from concurrent.futures import Executor
+
+import web_search
+import url_parcer
+import reranker
+import answer_generator
+import context_packer
+import metrics
+
+from answer_cache import answer_cache, SemanticAnswerCache
+from paraphrase import paraphrase_query, aparaphrase_many, cached_paraphrases, ParaphaseMode
+from fetcher import run_sync
+from page_cache import normalize_url
+from documents import Document, EmbeddingMatrix
+from session import ConversationSession
+
+logger = logging.getLogger(__name__)
+
+# Part of a URL's fetch priority that depends on search relevance alone; the rest scales with its domain's usefulness
+FETCH_RELEVANCE_WEIGHT = 0.5
+# Seconds after which a search call is sent a second time; unset or empty disables hedging
+HEDGE_AFTER = float(os.getenv("HEDGE_AFTER") or 0) or None
+
+
+class PipelineResult:
+    """
+    Outcome of one pipeline run.
+
+    :param query: The user's query.
+    :param paraphrases: Search queries produced by the paraphrase stage.
+    :param documents: Top documents after reranking and context packing.
+    :param answer: Generated answer, None until the generation stage runs.
+    :param timings: Seconds from the start of the run to the end of each stage.
+    :param cascade: Chunk counts of the lexical -> cross-encoder cascade.
+    :param cached: The answer cache entry if the answer was served from the cache, else None.
+    :param over_budget: Stages that ran out of their share of the deadline and were cut short.
+    :param session: Conversation the query belongs to, None for a standalone query.
+    :param history: The conversation's earlier turns passed to the LLM.
+    :param reused: True if the documents were extracted from the previous turn's pages instead of searched for.
+    """
+
+    def __init__(self, query: str):
+        self.query = query
+        self.paraphrases = []
+        self.documents = []
+        self.answer = None
+        self.timings = {}
+        self.cascade = url_parcer.CascadeReport()
+        self.cached = None
+        self.over_budget = []
+        self.session = None
+        self.history = []
+        self.reused = False
+        self.started = time.perf_counter()
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+
+class LatencyBudget:
+    """
+    Per-query deadline split into stage deadlines, in seconds from the start of the query.
+
+    Every stage before reranking gets the part of the deadline given by its share in ``STAGE_SHARES``:
+    paraphrasing has to finish within the first 15%, searching within 35%, fetching within 70%, and
+    extraction ends at the deadline itself. Reranking and generation are not limited.
+
+    :param deadline: Total seconds for everything before reranking.
+    """
+
+    STAGE_SHARES = {"paraphrase": 0.15, "search": 0.35, "fetch": 0.7, "extract": 1.0}
+
+    def __init__(self, deadline: float):
+        self.deadline = deadline
+        self.stage_deadlines = {stage: share * deadline for stage, share in self.STAGE_SHARES.items()}
+
+    def remaining(self, stage: str, elapsed: float) -> float:
+        return max(0.0, self.stage_deadlines[stage] - elapsed)
+
+
+class _RunState:
+    def __init__(self, result: PipelineResult, queue_size: int, budget: LatencyBudget):
+        self.paraphrases = result.paraphrases
+        self.timings = result.timings
+        self.elapsed = result.elapsed
+        self.over_budget = result.over_budget
+        self.budget = budget
+        self.cascade = result.cascade
+        # Entries are (circuit open, -priority, sequence number, URL key): the best fused URL on a healthy domain
+        # is fetched first, and URLs on domains with an open circuit only after all others
+        self.url_queue = asyncio.PriorityQueue()
+        self.page_queue = asyncio.Queue(queue_size)
+        self.urls = {}
+        self.url_scores = {}
+        self.fetched = set()
+        self.sequence = itertools.count()
+        self.pages = {}
+        self.candidates = []
+        self.document_ids = itertools.count()
+        self.embeddings = EmbeddingMatrix()
+        self.enough = asyncio.Event()
+
+
+class RetrievalPipeline:
+    """
+    Streaming search pipeline: paraphrase -> search -> fetch -> extract + embed -> rerank -> answer.
+
+    Stages run concurrently and are connected by queues: every paraphrase is searched on every engine
+    at once, and pages are fetched as soon as the first search returns URLs, each URL once, in the order of
+    their reciprocal-rank-fused score weighted by the health of their domain (see domain_health). Each page is chunked, scored against all paraphrases and embedded as soon
+    as it arrives. Reranking starts when every stage is done, when ``candidate_quota`` documents are ready,
+    or when ``deadline`` seconds have passed, whichever comes first.
+
+    Each stage also has its own share of the deadline (see LatencyBudget): a slow paraphrase falls back to
+    the user's query, searches still running at the search deadline are dropped, and at the fetch deadline
+    the pages still downloading are dropped while the ones already fetched are extracted. Search calls that
+    take longer than ``hedge_after`` seconds are sent a second time and the first response wins; the second
+    call takes its own search slot and is not sent when none is free, since every call costs search quota.
+
+    :param num_results: URLs requested from each engine for each paraphrase.
+    :param paraphrase_mode: Paraphrase mode for the search queries.
+    :param fetch_workers: Number of pages downloaded at the same time.
+    :param queue_size: Capacity of the queues between stages.
+    :param extract_batch_pages: Maximum number of pages scored in one cross-encoder call.
+    :param candidate_quota: Number of extracted documents after which reranking starts.
+    :param deadline: Seconds after which reranking starts with whatever is ready; can be overridden per query.
+    :param hedge_after: Seconds after which a search call is duplicated, best set to a high percentile (e.g. p95)
+        of the "search" span in the metrics; None disables hedging. Defaults to the HEDGE_AFTER env var.
+    :param top_n: Number of documents passed to the answer generator.
+    :param context_tokens: Token budget of the documents passed to the answer generator.
+    :param lexical_top_k: Chunks per page kept by the TF-IDF stage for the cross-encoder; None scores every chunk.
+    :param chunk_overlap: Characters shared by neighbouring chunks; half a chunk if None.
+    :param answer_cache: Semantic cache of answers; None disables it.
+    :param executor: Executor for the blocking stages (LLM, HTTP search, models); the loop's default one if None.
+    :param search_limit: Search calls in flight across all queries of this pipeline; None for no limit.
+    :param fetch_limit: Page downloads in flight across all queries; None leaves only ``fetch_workers`` per query.
+    :param llm_limit: LLM calls (paraphrasing and answers) in flight across all queries; None for no limit.
+    """
+
+    def __init__(self,
+                 num_results: int = 10,
+                 paraphrase_mode: ParaphaseMode = ParaphaseMode.SIMPLIFY,
+                 fetch_workers: int = 16,
+                 queue_size: int = 64,
+                 extract_batch_pages: int = 8,
+                 candidate_quota: int = 40,
+                 deadline: float = 20.0,
+                 hedge_after: float | None = HEDGE_AFTER,
+                 top_n: int = 5,
+                 context_tokens: int = context_packer.CONTEXT_TOKEN_BUDGET,
+                 lexical_top_k: int | None = url_parcer.LEXICAL_TOP_K,
+                 chunk_overlap: int | None = None,
+                 answer_cache: SemanticAnswerCache | None = answer_cache,
+                 executor: Executor | None = None,
+                 search_limit: int | None = None,
+                 fetch_limit: int | None = None,
+                 llm_limit: int | None = None):
+        self.num_results = num_results
+        self.paraphrase_mode = paraphrase_mode
+        self.fetch_workers = fetch_workers
+        self.queue_size = queue_size
+        self.extract_batch_pages = extract_batch_pages
+        self.candidate_quota = candidate_quota
+        self.deadline = deadline
+        self.hedge_after = hedge_after
+        self.top_n = top_n
+        self.context_tokens = context_tokens
+        self.lexical_top_k = lexical_top_k
+        self.chunk_overlap = chunk_overlap
+        self.answer_cache = answer_cache
+        self.executor = executor
+        self.limits = {"search": search_limit, "fetch": fetch_limit, "llm": llm_limit}
+        self._semaphores = {}
+
+    def _limit(self, kind: str):
+        """Slot of the shared limit for a kind of call, or a no-op context if it is not limited."""
+        if self.limits.get(kind) is None:
+            return contextlib.nullcontext()
+        if kind not in self._semaphores:
+            self._semaphores[kind] = asyncio.Semaphore(self.limits[kind])
+        return self._semaphores[kind]
+
+    def _limit_full(self, kind: str) -> bool:
+        limit = self._limit(kind)
+        return isinstance(limit, asyncio.Semaphore) and limit.locked()
+
+    async def _in_executor(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def _hedged_search(self, searcher, query):
+        calls = {asyncio.ensure_future(self._in_executor(searcher.search, query, self.num_results))}
+        done, _ = await asyncio.wait(calls, timeout=self.hedge_after)
+        if not done and self._limit_full("search"):
+            logger.info("Not hedging slow %s search for %r: no free search slot", searcher.engine.name, query)
+        elif not done:
+            logger.info("Hedging slow %s search for %r", searcher.engine.name, query)
+            metrics.hedged_request(searcher.engine.name)
+            calls.add(asyncio.ensure_future(self._hedge(searcher, query)))
+        error = None
+        try:
+            while calls:
+                done, calls = await asyncio.wait(calls, return_when=asyncio.FIRST_COMPLETED)
+                for call in done:
+                    if call.exception() is None:
+                        return call.result()
+                    error = call.exception()
+            raise error
+        finally:
+            for call in calls:
+                call.cancel()
+
+    async def _hedge(self, searcher, query):
+        # The duplicate counts against the search limit like any other call
+        async with self._limit("search"):
+            return await self._in_executor(searcher.search, query, self.num_results)
+
+    async def _search_one(self, searcher, query):
+        try:
+            async with self._limit("search"):
+                if self.hedge_after is None:
+                    return query, await self._in_executor(searcher.search, query, self.num_results)
+                return query, await self._hedged_search(searcher, query)
+        except Exception as e:
+            logger.warning("Search for %r failed: %s", query, e)
+            return query, None
+
+    async def _search_stage(self, state: _RunState):
+        searches = []
+        try:
+            searches = [asyncio.ensure_future(self._search_one(searcher, q))
+                        for q in state.paraphrases
+                        for searcher in web_search.get_searchers().values()]
+            timeout = state.budget.remaining("search", state.elapsed())
+            for next_done in asyncio.as_completed(searches, timeout=timeout):
+                self._queue_urls(state, *await next_done)
+        except asyncio.TimeoutError:
+            state.over_budget.append("search")
+            logger.info("Search budget exhausted, %d searches dropped", sum(not search.done() for search in searches))
+        finally:
+            for search in searches:
+                search.cancel()
+            state.timings["search"] = state.elapsed()
+            # Also on errors, so the fetch workers stop instead of waiting for the fetch deadline
+            for _ in range(self.fetch_workers):
+                state.url_queue.put_nowait((True, math.inf, next(state.sequence), None))
+
+    def _queue_urls(self, state: _RunState, q: str, results: list[dict] | None):
+        state.timings.setdefault("first_search", state.elapsed())
+        ranking = []
+        for result in results or []:
+            if result.get("url"):
+                key = normalize_url(result["url"])
+                state.urls.setdefault(key, result["url"])
+                ranking.append(key)
+        # Fused scores grow as more rankings arrive; a URL is queued again with its new score
+        # and the fetch workers skip the stale entries
+        for key, score in web_search.reciprocal_rank_fusion([ranking]).items():
+            state.url_scores[key] = state.url_scores.get(key, 0.0) + score
+            if key not in state.fetched:
+                state.url_queue.put_nowait((*self._fetch_priority(state, key), next(state.sequence), key))
+
+    def _fetch_priority(self, state: _RunState, key: str) -> tuple[bool, float]:
+        # Queue sort key: open circuits last, then slow, failing or nearly empty domains later
+        health = url_parcer.domain_health
+        if health is None:
+            return False, -state.url_scores[key]
+        url = state.urls[key]
+        score = state.url_scores[key] * (FETCH_RELEVANCE_WEIGHT + (1 - FETCH_RELEVANCE_WEIGHT) * health.usefulness(url))
+        return health.is_open(url), -score
+
+    async def _fetch_stage(self, state: _RunState):
+        while True:
+            *_, key = await state.url_queue.get()
+            if key is None:
+                break
+            if key in state.fetched:
+                continue
+            state.fetched.add(key)
+            url = state.urls[key]
+            try:
+                # The slot is held by the download, which outlives this worker if it gives up at the deadline
+                markdown = await url_parcer.parse_url_async(url, limit=self._limit("fetch"))
+            except Exception as e:
+                logger.info("Skipping %s: %s", url, e)
+                continue
+            await state.page_queue.put((url, markdown))
+
+    def _extract_and_embed(self, state: _RunState, pages: list[tuple[str, str]]):
+        pages = dict(pages)
+        state.pages.update(pages)
+        documents = url_parcer.extract_documents(state.paraphrases, pages, state.document_ids,
+                                                 chunk_overlap=self.chunk_overlap, lexical_top_k=self.lexical_top_k,
+                                                 report=state.cascade)
+        # Embedded once here; the rerank stage reads the rows from the run's matrix
+        embeddings = reranker.batch_encode([document.text for document in documents], is_query=False)
+        for document, row in zip(documents, state.embeddings.add(embeddings)):
+            document.emb_row = row
+        state.candidates.extend(documents)
+
+    async def _extract_stage(self, state: _RunState):
+        finished = False
+        while not finished:
+            page = await state.page_queue.get()
+            if page is None:
+                break
+            pages = [page]
+            while len(pages) < self.extract_batch_pages and not state.page_queue.empty():
+                page = state.page_queue.get_nowait()
+                if page is None:
+                    finished = True
+                    break
+                pages.append(page)
+            await self._in_executor(self._extract_and_embed, state, pages)
+            state.timings.setdefault("first_document", state.elapsed())
+            if len(state.candidates) >= self.candidate_quota:
+                state.enough.set()
+
+    async def _fetch_all(self, state: _RunState):
+        await asyncio.gather(*(self._fetch_stage(state) for _ in range(self.fetch_workers)))
+        state.timings["fetch"] = state.elapsed()
+        await state.page_queue.put(None)
+
+    async def _from_cache(self, result: PipelineResult, query: str) -> bool:
+        if self.answer_cache is None:
+            return False
+        hit = await self._in_executor(self.answer_cache.get, query)
+        if hit is None:
+            return False
+        logger.info("Answer for %r served from the cache of %r (similarity %.3f)", result.query, hit.query, hit.similarity)
+        result.cached = hit
+        result.answer = hit.answer
+        result.documents = [Document(i, url, "") for i, url in enumerate(hit.sources)]
+        result.timings["cache"] = result.elapsed()
+        return True
+
+    async def _remember(self, result: PipelineResult):
+        if result.session is not None and result.answer:
+            result.session.add_turn(result.query, result.answer)
+        if self.answer_cache is None or result.cached is not None or not result.answer or not result.documents:
+            return
+        sources = [document.url for document in result.documents]
+        queries = set() if result.history else {result.query}
+        if result.paraphrases and not result.reused and (not result.history or result.paraphrases[0] != result.query):
+            queries.add(result.paraphrases[0])
+        for query in queries:
+            await self._in_executor(self.answer_cache.put, query, result.answer, sources)
+
+    async def _paraphrase_limited(self, query: str, history: list[str]) -> list[str]:
+        # A cached paraphrase needs no LLM slot
+        paraphrases = cached_paraphrases(query, self.paraphrase_mode, history)
+        if paraphrases is not None:
+            return paraphrases
+        async with self._limit("llm"):
+            return await self._in_executor(paraphrase_query, query, self.paraphrase_mode, history)
+
+    async def paraphrase_many(self, queries: list[str]) -> list[list[str]]:
+        """
+        Paraphrases several queries with concurrent LLM calls, each taking an LLM slot only while it runs.
+        The results land in the paraphrase cache, so running these queries later skips the paraphrase LLM call.
+        """
+
+        return await aparaphrase_many(queries, self.paraphrase_mode, limit=self._limit("llm"))
+
+    async def _paraphrase(self, result: PipelineResult, budget: LatencyBudget) -> list[str]:
+        try:
+            return await asyncio.wait_for(self._paraphrase_limited(result.query, result.history),
+                                          budget.remaining("paraphrase", result.elapsed()))
+        except asyncio.TimeoutError:
+            result.over_budget.append("paraphrase")
+            logger.info("Paraphrasing %r ran out of budget, searching for the query itself", result.query)
+            return [result.query]
+
+    @staticmethod
+    def _raise_failed(*tasks: asyncio.Task):
+        # A stage that crashed (e.g. no search API keys) fails the query instead of answering from nothing
+        for task in tasks:
+            if task.done() and not task.cancelled() and task.exception() is not None:
+                raise task.exception()
+
+    async def _retrieve_documents(self, state: _RunState):
+        searching = asyncio.create_task(self._search_stage(state))
+        fetching = asyncio.create_task(self._fetch_all(state))
+        extracting = asyncio.create_task(self._extract_stage(state))
+        enough = asyncio.create_task(state.enough.wait())
+        stages = (searching, fetching, extracting)
+        try:
+            waiting = {fetching, enough, searching, extracting}
+            while True:
+                done, waiting = await asyncio.wait(waiting, timeout=state.budget.remaining("fetch", state.elapsed()),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                self._raise_failed(*stages)
+                if not done or fetching.done() or enough.done():
+                    break
+            if enough.done():
+                return
+            if not fetching.done():
+                # Stragglers are dropped; the pages that already arrived are still extracted
+                state.over_budget.append("fetch")
+                searching.cancel()
+                fetching.cancel()
+                await state.page_queue.put(None)
+                state.timings["fetch"] = state.elapsed()
+
+            done, _ = await asyncio.wait([extracting, enough], timeout=state.budget.remaining("extract", state.elapsed()),
+                                         return_when=asyncio.FIRST_COMPLETED)
+            self._raise_failed(*stages)
+            if not done:
+                state.over_budget.append("extract")
+        finally:
+            for task in (searching, fetching, extracting, enough):
+                task.cancel()
+
+    @staticmethod
+    def _rank_query(result: PipelineResult) -> str:
+        if result.history and result.paraphrases:
+            return result.paraphrases[0]
+        return result.query
+
+    async def _rank_and_pack(self, result: PipelineResult, candidates: list[Document], embeddings: EmbeddingMatrix):
+        result.documents = await self._in_executor(reranker.rerank, self._rank_query(result), candidates, embeddings,
+                                                   self.top_n)
+        result.timings["rerank"] = result.elapsed()
+        # Near-duplicate passages are dropped and the rest is cut to the token budget, keeping rerank order
+        result.documents = await self._in_executor(context_packer.pack_context, result.documents, self.context_tokens)
+        result.timings["pack"] = result.elapsed()
+
+    def _session_pages(self, session: ConversationSession, query: str) -> dict[str, str] | None:
+        return session.pages_for(reranker.batch_encode([query], is_query=True)[0])
+
+    def _keep_session_documents(self, session: ConversationSession, query: str, state: _RunState):
+        # The query embedding is already in the embedding cache after reranking
+        session.keep_documents(query, reranker.batch_encode([query], is_query=True)[0], state.pages,
+                               state.candidates, state.embeddings)
+
+    async def retrieve(self, query: str, deadline: float | None = None,
+                       session: ConversationSession | None = None) -> PipelineResult:
+        """
+        Runs every stage up to and including reranking.
+
+        The answer cache is checked with the user's query before paraphrasing and with the refined query
+        before searching; on a hit the result already holds the cached answer and its sources.
+
+        In a conversation, a follow-up that the previous turn's documents cover as well as the question they
+        were found for is answered from the pages fetched then: they are scored again for the follow-up and
+        reranked, with no paraphrasing, search or fetching. Other follow-ups are paraphrased with the
+        conversation's history, so they become standalone searches, and are reranked with the refined query.
+
+        :param query: The user's query.
+        :param deadline: Seconds for everything before reranking; the pipeline's deadline if None.
+        :param session: Conversation the query belongs to; for follow-ups the answer cache is only checked
+            with the refined query.
+        :return: PipelineResult with paraphrases, top documents and timings filled in.
+        """
+
+        result = PipelineResult(query)
+        budget = LatencyBudget(deadline or self.deadline)
+        if session is not None:
+            result.session = session
+            result.history = session.history()
+            pages = await self._in_executor(self._session_pages, session, query) if result.history else None
+            if pages is not None:
+                result.reused = True
+                # The pages are scored for the follow-up together with the question they were found for
+                result.paraphrases = [query, session.query]
+                result.timings["followup_check"] = result.elapsed()
+                state = _RunState(result, self.queue_size, budget)
+                await self._in_executor(self._extract_and_embed, state, list(pages.items()))
+                result.timings["extract"] = result.elapsed()
+                await self._rank_and_pack(result, state.candidates, state.embeddings)
+                return result
+        if not result.history and await self._from_cache(result, query):
+            return result
+        result.paraphrases = await self._paraphrase(result, budget)
+        result.timings["paraphrase"] = result.elapsed()
+        if result.paraphrases and result.paraphrases[0] != query and await self._from_cache(result, result.paraphrases[0]):
+            return result
+        state = _RunState(result, self.queue_size, budget)
+
+        await self._retrieve_documents(state)
+        result.timings["extract"] = state.elapsed()
+
+        await self._rank_and_pack(result, list(state.candidates), state.embeddings)
+        if session is not None:
+            await self._in_executor(self._keep_session_documents, session, self._rank_query(result), state)
+        logger.info("Cascade for %r: %s", query, result.cascade.as_dict())
+        if result.over_budget:
+            logger.info("Stages over budget for %r: %s", query, result.over_budget)
+        return result
+
+    async def generate(self, result: PipelineResult) -> PipelineResult:
+        """Generates the answer for a result returned by retrieve."""
+        if result.cached is not None:
+            await self._remember(result)
+            return result
+        async with self._limit("llm"):
+            result.answer = await self._in_executor(answer_generator.generate_answer, result.query, result.documents,
+                                                    result.history)
+        result.timings["generate"] = result.elapsed()
+        await self._remember(result)
+        return result
+
+    async def generate_stream(self, result: PipelineResult):
+        """
+        Generates the answer for a result returned by retrieve, yielding text fragments as the LLM produces them.
+
+        The LLM runs in the executor; once the stream is exhausted ``result.answer`` holds the full text.
+        Closing the iterator early stops reading from the LLM.
+
+        :param result: Result returned by retrieve.
+        :return: Async iterator of answer fragments.
+        """
+
+        if result.cached is not None:
+            yield result.answer
+            await self._remember(result)
+            return
+
+        loop = asyncio.get_running_loop()
+        fragments = asyncio.Queue()
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for fragment in answer_generator.generate_answer_stream(result.query, result.documents, result.history):
+                    if stop.is_set():
+                        break
+                    loop.call_soon_threadsafe(fragments.put_nowait, fragment)
+            except Exception as e:
+                loop.call_soon_threadsafe(fragments.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(fragments.put_nowait, None)
+
+        parts = []
+        # The LLM slot is held for the whole stream
+        async with self._limit("llm"):
+            producer = loop.run_in_executor(self.executor, produce)
+            try:
+                while (fragment := await fragments.get()) is not None:
+                    if isinstance(fragment, Exception):
+                        raise fragment
+                    result.timings.setdefault("first_token", result.elapsed())
+                    parts.append(fragment)
+                    yield fragment
+                await producer
+            finally:
+                stop.set()
+        result.answer = "".join(parts).strip()
+        result.timings["generate"] = result.elapsed()
+        await self._remember(result)
+
+    async def run(self, query: str, deadline: float | None = None,
+                  session: ConversationSession | None = None) -> PipelineResult:
+        return await self.generate(await self.retrieve(query, deadline, session))
+
+    def run_sync(self, query: str, deadline: float | None = None,
+                 session: ConversationSession | None = None) -> PipelineResult:
+        """Synchronous run on the fetcher's background event loop, so the connection pool is reused between queries."""
+        return run_sync(self.run(query, deadline, session))
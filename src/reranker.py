@@ -1,61 +1,124 @@
+import os
 import numpy as np
 
-from sklearn.metrics.pairwise import cosine_similarity
+import inference
+import metrics
 
-from models import cross_encoder, bi_encoder
+from models import BI_ENCODER_NAME
+from documents import Document, EmbeddingMatrix
+from embedding_cache import EmbeddingCache, make_key, DEFAULT_MEMORY_ENTRIES
+
+MMR_PREFILTER_K = 200
+
+embedding_cache = EmbeddingCache(
+    max_entries=int(os.getenv("EMBEDDING_CACHE_SIZE", DEFAULT_MEMORY_ENTRIES)),
+    disk_path=os.getenv("EMBEDDING_CACHE_DIR"),
+)
+
+def _prefix(is_query):
+    return "query: " if is_query else "passage: "
 
 def preprocess(texts, is_query=True):
-    prefix = "query: " if is_query else "passage: "
+    prefix = _prefix(is_query)
     return [prefix + text.strip() for text in texts]
 
 def batch_encode(texts, is_query=True, batch_size=8):
-    """Encodes texts using batching."""
-    processed_texts = preprocess(texts, is_query)
-    embeddings = []
-    for i in range(0, len(processed_texts), batch_size):
-        batch = processed_texts[i:i + batch_size]
-        embeddings_batch = bi_encoder.encode(batch)
-        embeddings.extend(embeddings_batch)
+    """
+    Encodes texts using batching.
+    Embeddings are looked up in the embedding cache first; only the misses go to the inference service,
+    in one call that it batches together with other requests. batch_size is ignored and kept for compatibility.
+    """
+    prefix = _prefix(is_query)
+    keys = [make_key(BI_ENCODER_NAME, prefix, text.strip()) for text in texts]
+    embeddings = [embedding_cache.get(key) for key in keys]
+    
+    missing = {}
+    for i, (key, embedding) in enumerate(zip(keys, embeddings)):
+        if embedding is None:
+            missing.setdefault(key, []).append(i)
+    metrics.cache_hit("embedding", len(keys) - sum(len(positions) for positions in missing.values()))
+    metrics.cache_miss("embedding", len(missing))
+    
+    if missing:
+        missing_texts = [prefix + texts[positions[0]].strip() for positions in missing.values()]
+        with metrics.span("embed"):
+            encoded = inference.service.encode(missing_texts)
+        for (key, positions), embedding in zip(missing.items(), encoded):
+            embedding_cache.put(key, embedding)
+            for i in positions:
+                embeddings[i] = embedding
     return np.array(embeddings)
 
-def mmr(query_embedding, doc_embeddings, documents, top_n=5, lambda_param=0.7):
+def _normalize(embeddings):
+    """L2-normalizes rows, leaving all-zero rows as they are."""
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return embeddings / norms
+
+def mmr(query_embedding, doc_embeddings, documents, top_n=5, lambda_param=0.7, prefilter_k=None):
     """
     Maximal Marginal Relevance (MMR) for document selection.
     Selects documents that are both relevant to the query and diverse from each other.
     
+    Embeddings are normalized once, and the maximum similarity of every candidate to the
+    selected set is kept as a running vector updated with one matrix-vector product per round.
+    
     :param query_embedding: Embedding of the query.
     :param doc_embeddings: List of document embeddings.
     :param documents: List of documents.
     :param top_n: Number of documents to select.
     :param lambda_param: Trade-off parameter between relevance and diversity.
+    :param prefilter_k: If set, only the prefilter_k documents most relevant to the query take part in the selection.
     :return: List of selected documents.
     """
     
+    if len(documents) == 0:
+        return []
+    
+    with metrics.span("mmr"):
+        return _mmr(query_embedding, doc_embeddings, documents, top_n, lambda_param, prefilter_k)
+
+def _mmr(query_embedding, doc_embeddings, documents, top_n, lambda_param, prefilter_k):
+    doc_embeddings = _normalize(np.asarray(doc_embeddings))
+    query_embedding = _normalize(np.atleast_2d(np.asarray(query_embedding)))[0]
+    query_similarities = doc_embeddings @ query_embedding
+    
+    candidates = np.arange(len(doc_embeddings))
+    if prefilter_k is not None and len(candidates) > prefilter_k:
+        candidates = np.sort(np.argpartition(-query_similarities, prefilter_k - 1)[:prefilter_k])
+        doc_embeddings = doc_embeddings[candidates]
+        query_similarities = query_similarities[candidates]
+    
+    top_n = min(top_n, len(candidates))
+    relevance = lambda_param * query_similarities
+    max_similarity = np.zeros(len(candidates), dtype=relevance.dtype)
+    is_selected = np.zeros(len(candidates), dtype=bool)
     selected_indices = []
-    remaining_indices = list(range(len(doc_embeddings)))
-    query_similarities = cosine_similarity(query_embedding, doc_embeddings).flatten()
-    print("query similarities", query_similarities)
-    for _ in range(top_n):
-        mmr_scores = []
-        for i in remaining_indices:
-            diversity_score = max(
-                cosine_similarity([doc_embeddings[i]], [doc_embeddings[j]])[0][0]
-                for j in selected_indices
-            ) if selected_indices else 0
-            
-            mmr_score = lambda_param * query_similarities[i] - (1 - lambda_param) * diversity_score
-            mmr_scores.append((i, mmr_score))
-        best_doc = max(mmr_scores, key=lambda x: x[1])
-        selected_indices.append(best_doc[0])
-        remaining_indices.remove(best_doc[0])
-    
-    selected = []
-    for idx in selected_indices:
-        selected.append(documents[idx])
-    return selected
-
-def rerank_documents(query, documents, top_n=5, mmr_lambda=0.5, batch_size=8):
+    for step in range(top_n):
+        mmr_scores = relevance - (1 - lambda_param) * max_similarity
+        mmr_scores[is_selected] = -np.inf
+        best_doc = int(np.argmax(mmr_scores))
+        selected_indices.append(best_doc)
+        is_selected[best_doc] = True
+        
+        similarity = doc_embeddings @ doc_embeddings[best_doc]
+        max_similarity = similarity if step == 0 else np.maximum(max_similarity, similarity)
+    
+    return [documents[candidates[idx]] for idx in selected_indices]
+
+def rerank_documents(query, documents, top_n=5, mmr_lambda=0.5, batch_size=8, prefilter_k=MMR_PREFILTER_K):
     query_embedding = batch_encode([query], is_query=True, batch_size=1)
     doc_embeddings = batch_encode(documents, is_query=False, batch_size=batch_size)
-    print("query embedding", query_embedding)
-    return mmr(query_embedding, doc_embeddings, documents, top_n, mmr_lambda)
\ No newline at end of file
+    return mmr(query_embedding, doc_embeddings, documents, top_n, mmr_lambda, prefilter_k)
+
+def rerank(query, documents: list[Document], embeddings: EmbeddingMatrix, top_n=5, mmr_lambda=0.5, prefilter_k=MMR_PREFILTER_K) -> list[Document]:
+    """
+    Same as rerank_documents for Document records whose embeddings are already in ``embeddings``:
+    only the query is encoded, the documents' rows are taken from the matrix.
+    
+    :return: The selected documents, best first.
+    """
+    if len(documents) == 0:
+        return []
+    query_embedding = batch_encode([query], is_query=True, batch_size=1)
+    return mmr(query_embedding, embeddings.rows(documents), documents, top_n, mmr_lambda, prefilter_k)
@@ -0,0 +1,90 @@
+import asyncio
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Superseded(Exception):
+    """Raised for a query cancelled because the same user sent a newer one."""
+    pass
+
+
+class QueryScheduler:
+    """
+    Admission control for pipeline runs on one event loop.
+
+    At most ``max_concurrent`` queries run at once and at most ``max_queued`` more wait for a slot;
+    further queries are rejected with QueueFull. Each user may have ``per_user_limit`` queries
+    in flight: a newer query cancels that user's oldest one, which then raises Superseded.
+    """
+
+    def __init__(self, max_concurrent: int = 4, max_queued: int = 16, per_user_limit: int = 1):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.per_user_limit = per_user_limit
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._waiting = []
+        self._user_jobs = {}
+        self._superseded = set()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiting)
+
+    async def _job(self, coro_fn, on_wait):
+        if self._slots.locked():
+            ticket = object()
+            self._waiting.append(ticket)
+            try:
+                if on_wait is not None:
+                    await on_wait(len(self._waiting))
+                await self._slots.acquire()
+            finally:
+                self._waiting.remove(ticket)
+        else:
+            await self._slots.acquire()
+        try:
+            return await coro_fn()
+        finally:
+            self._slots.release()
+
+    async def run(self, user_id, coro_fn, on_wait=None):
+        """
+        Runs ``coro_fn()`` once a slot is free.
+
+        :param user_id: Key for the per-user limit, e.g. the Telegram chat id.
+        :param coro_fn: Function returning the coroutine to run.
+        :param on_wait: Optional coroutine function called with the queue position if the query has to wait.
+        :return: The coroutine's result.
+        :raises QueueFull: If the queue is full.
+        :raises Superseded: If a newer query of the same user cancelled this one.
+        """
+
+        user_jobs = self._user_jobs.setdefault(user_id, [])
+        # A query that replaces the same user's older one takes its place instead of queueing anew
+        if len(user_jobs) < self.per_user_limit and self._slots.locked() and len(self._waiting) >= self.max_queued:
+            if not user_jobs:
+                del self._user_jobs[user_id]
+            raise QueueFull(f"{len(self._waiting)} queries are already waiting")
+
+        while len(user_jobs) >= self.per_user_limit:
+            older = user_jobs.pop(0)
+            self._superseded.add(older)
+            older.cancel()
+
+        job = asyncio.create_task(self._job(coro_fn, on_wait))
+        user_jobs.append(job)
+        try:
+            return await job
+        except asyncio.CancelledError:
+            if job in self._superseded:
+                raise Superseded() from None
+            job.cancel()
+            raise
+        finally:
+            self._superseded.discard(job)
+            if job in user_jobs:
+                user_jobs.remove(job)
+            if not user_jobs:
+                self._user_jobs.pop(user_id, None)
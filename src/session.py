@@ -0,0 +1,162 @@
+import os
+import time
+import logging
+
+from collections import OrderedDict
+
+import numpy as np
+
+from documents import Document, EmbeddingMatrix
+
+logger = logging.getLogger(__name__)
+
+MAX_HISTORY_TURNS = int(os.getenv("SESSION_HISTORY_TURNS", 5))
+# Characters of the history put into a prompt, the most recent ones
+MAX_HISTORY_CHARS = int(os.getenv("SESSION_HISTORY_CHARS", 3000))
+# Seconds the last turn's documents may be reused for follow-ups
+MATERIAL_TTL = float(os.getenv("SESSION_MATERIAL_TTL", 900))
+# How much worse than the original question a follow-up may match the documents and still reuse them
+FOLLOWUP_MARGIN = float(os.getenv("SESSION_FOLLOWUP_MARGIN", 0.03))
+DEFAULT_MAX_SESSIONS = 10_000
+DEFAULT_SESSION_TTL = 24 * 3600
+
+
+def _unit(vector: np.ndarray) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def format_history(history: list[str] | None, max_chars: int = MAX_HISTORY_CHARS) -> str:
+    """
+    The history as a block for an LLM prompt, cut to its last ``max_chars`` characters; "" without history.
+    """
+
+    if not history:
+        return ""
+    return "Предыдущий диалог:\n" + "\n".join(history)[-max_chars:]
+
+
+class ConversationSession:
+    """
+    State of one conversation: the last turns for the LLM, and the pages fetched for the last question
+    that needed a web search, with the documents extracted from them and their embeddings.
+
+    A follow-up question is answered from those pages when it matches the documents about as well as the
+    question they were retrieved for: the best cosine similarity between the follow-up's embedding and
+    the documents' embeddings must be at least the original question's best similarity minus ``margin``.
+    The pages are then scored again for the follow-up, since it may need other parts of them.
+
+    :param max_turns: Number of (question, answer) turns kept for the history.
+    :param material_ttl: Seconds after which the documents are considered stale and a new search is made.
+    :param margin: Allowed drop of the best query-document similarity for a follow-up.
+    """
+
+    def __init__(self, max_turns: int = MAX_HISTORY_TURNS, material_ttl: float = MATERIAL_TTL,
+                 margin: float = FOLLOWUP_MARGIN):
+        self.max_turns = max_turns
+        self.material_ttl = material_ttl
+        self.margin = margin
+        self.turns = []
+        self.query = None
+        self.pages = {}
+        self.documents = []
+        self.embeddings = None
+        self.coverage = 0.0
+        self.retrieved_at = 0.0
+        self.used_at = time.monotonic()
+
+    def history(self) -> list[str]:
+        """The kept turns as lines, oldest first."""
+        lines = []
+        for query, answer in self.turns:
+            lines.append("Пользователь: " + query)
+            lines.append("AI-агент: " + answer)
+        return lines
+
+    def add_turn(self, query: str, answer: str):
+        self.turns.append((query, answer))
+        del self.turns[:-self.max_turns]
+        self.used_at = time.monotonic()
+
+    def _coverage(self, query_embedding: np.ndarray) -> float:
+        if not self.documents:
+            return float("-inf")
+        rows = self.embeddings.rows(self.documents)
+        rows = rows / np.maximum(np.linalg.norm(rows, axis=1, keepdims=True), 1e-12)
+        return float(np.max(rows @ _unit(query_embedding)))
+
+    def keep_documents(self, query: str, query_embedding: np.ndarray, pages: dict[str, str],
+                       documents: list[Document], embeddings: EmbeddingMatrix):
+        """
+        Stores the material retrieved for a question, replacing the previous turn's.
+
+        :param query: The standalone question it was retrieved for.
+        :param query_embedding: Embedding of that question.
+        :param pages: Mapping from URL to the full text of every fetched page.
+        :param documents: All extracted candidates, before reranking.
+        :param embeddings: Matrix holding their embeddings.
+        """
+
+        self.query = query
+        self.pages = dict(pages)
+        self.documents = list(documents)
+        self.embeddings = embeddings
+        self.coverage = self._coverage(query_embedding)
+        self.retrieved_at = time.monotonic()
+
+    def pages_for(self, query_embedding: np.ndarray) -> dict[str, str] | None:
+        """
+        The stored pages if a follow-up with this embedding can be answered from them, else None.
+        """
+
+        if not self.documents:
+            return None
+        if time.monotonic() - self.retrieved_at > self.material_ttl:
+            self._drop_material()
+            return None
+        coverage = self._coverage(query_embedding)
+        reuse = coverage >= self.coverage - self.margin
+        logger.info("Follow-up coverage %.3f vs %.3f of the original question: %s",
+                    coverage, self.coverage, "reusing documents" if reuse else "searching again")
+        return self.pages if reuse else None
+
+    def _drop_material(self):
+        self.query = None
+        self.pages = {}
+        self.documents = []
+        self.embeddings = None
+        self.coverage = 0.0
+
+    def clear(self):
+        self.turns = []
+        self._drop_material()
+
+
+class SessionStore:
+    """
+    Conversation sessions by key (e.g. the Telegram chat id). Sessions unused for ``ttl`` seconds
+    are dropped, and beyond ``max_sessions`` the least recently used one is.
+    """
+
+    def __init__(self, max_sessions: int = DEFAULT_MAX_SESSIONS, ttl: float = DEFAULT_SESSION_TTL):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def get(self, key) -> ConversationSession:
+        """The session for a key, a new one if there is none or it expired."""
+        session = self._sessions.pop(key, None)
+        if session is None or time.monotonic() - session.used_at > self.ttl:
+            session = ConversationSession()
+        session.used_at = time.monotonic()
+        self._sessions[key] = session
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+        return session
+
+    def reset(self, key):
+        self._sessions.pop(key, None)
@@ -1,65 +1,138 @@
 import os
+import asyncio
 import logging
 import time
-import url_parcer
-import web_search
-import paraphrase
-import reranker
-import answer_generator
+import models
+import metrics
 
-from telegram import Update
+from concurrent.futures import ThreadPoolExecutor
+from pipeline import RetrievalPipeline
+from scheduler import QueryScheduler, QueueFull, Superseded
+from session import SessionStore
+
+from telegram import Update, Message
+from telegram.error import RetryAfter
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, filters
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+# Port of the Prometheus /metrics endpoint; metrics are not collected if unset
+METRICS_PORT = os.getenv("METRICS_PORT")
+
+# Blocking pipeline work (LLM, search HTTP calls, models) runs here, never on the event loop
+pipeline_executor = ThreadPoolExecutor(max_workers=int(os.getenv("PIPELINE_WORKERS", 8)), thread_name_prefix="pipeline")
+pipeline = RetrievalPipeline(executor=pipeline_executor)
+scheduler = QueryScheduler(
+    max_concurrent=int(os.getenv("MAX_CONCURRENT_QUERIES", 4)),
+    max_queued=int(os.getenv("MAX_QUEUED_QUERIES", 16)),
+    per_user_limit=1,
+)
+# Follow-up questions in a chat reuse its last turns and documents
+sessions = SessionStore()
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Telegram allows roughly one edit per second in a chat
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", 1.0))
+
+class StreamingReply:
+    """
+    Shows a growing answer by editing one reply at most once per ``interval`` seconds.
+    Text that does not fit into one Telegram message continues in a new reply.
+    """
+
+    def __init__(self, message: Message, prefix: str = "", interval: float = STREAM_EDIT_INTERVAL):
+        self.message = message
+        self.interval = interval
+        self.text = prefix
+        self._sent = None
+        self._shown = ""
+        self._last_update = 0.0
+
+    async def append(self, fragment: str):
+        self.text += fragment
+        if time.monotonic() - self._last_update >= self.interval:
+            await self.flush()
+
+    async def flush(self):
+        while len(self.text) > TELEGRAM_MESSAGE_LIMIT:
+            cut = self.text.rfind("\n", 0, TELEGRAM_MESSAGE_LIMIT)
+            if cut <= 0:
+                cut = TELEGRAM_MESSAGE_LIMIT
+            head, self.text = self.text[:cut], self.text[cut:].lstrip()
+            await self._show(head)
+            self._sent, self._shown = None, ""
+        if self.text.strip():
+            await self._show(self.text)
+        self._last_update = time.monotonic()
+
+    async def _show(self, text: str):
+        # Telegram trims messages and rejects edits that do not change them
+        text = text.strip()
+        if text == self._shown:
+            return
+        for attempt in range(2):
+            try:
+                if self._sent is None:
+                    self._sent = await self.message.reply_text(text)
+                else:
+                    await self._sent.edit_text(text)
+                self._shown = text
+                return
+            except RetryAfter as e:
+                if attempt:
+                    raise
+                logger.info("Telegram asked to wait %s s before the next edit", e.retry_after)
+                await asyncio.sleep(e.retry_after)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    sessions.reset(update.effective_chat.id)
     await update.message.reply_text("👋 Welcome to the AI Search Bot. Send me a query!")
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.message.text
-    await update.message.reply_text("🔍 Searching the web...")
 
-    try:
-        # Paraphrase the query
-        paraphrased_queries = paraphrase.paraphrase_query(query)
-        # Perform web search
-        visited_urls = set()
-        parsed_results = []
-        url_dict = dict()
-        
-        
-        for q in paraphrased_queries:
-            urls = web_search.parallel_search_yandex_google(q, num_results=10)
-            for url in urls:
-                if url not in visited_urls:
-                    try:
-                        md = url_parcer.parse_url(url)
-                    except Exception as e:
-                        continue
-                    
-                    relevant_from_url = url_parcer.extract_relevant(q, md)
-                    parsed_results.append(relevant_from_url)
-                    url_dict[relevant_from_url] = url
-                    visited_urls.add(url)
-        
-        await update.message.reply_text("🔍 Extracting top results...")
-        top_results = reranker.rerank_documents(query, parsed_results, top_n=5)
-        
-        await update.message.reply_text("🔍 Generating the answer...")
-        final_answer = answer_generator.generate_answer(query, [(url_dict[doc], doc) for doc in top_results])
+    async def on_wait(position):
+        await update.message.reply_text(f"⏳ The bot is busy, you are #{position} in queue...")
+
+    async def answer():
+        await update.message.reply_text("🔍 Searching the web...")
+        # Paraphrase, search, fetch, extract and rerank as one streaming pipeline
+        result = await pipeline.retrieve(query, session=sessions.get(update.effective_chat.id))
         
-        await update.message.reply_text(f"🤖 Answer:\n{(final_answer)}")
+        # The answer appears in one message that is edited as the LLM produces it
+        reply = StreamingReply(update.message, prefix="🤖 Answer:\n")
+        async for fragment in pipeline.generate_stream(result):
+            await reply.append(fragment)
+        await reply.flush()
+        logger.info("Answered %r, timings: %s", query, result.timings)
+
+    try:
+        await scheduler.run(update.effective_chat.id, answer, on_wait)
     
+    except QueueFull:
+        await update.message.reply_text("⏳ The bot is overloaded right now. Try again in a minute.")
+    except Superseded:
+        await update.message.reply_text(f"⏹ Stopped working on \"{query}\": you sent a newer query.")
     except Exception as e:
         logger.exception("Error handling message: %s", e)
         await update.message.reply_text("❌ Something went wrong. Try again later.")
 
+def _log_warmup(future):
+    try:
+        logger.info("Models warmed up: %s", {name: f"{seconds:.2f}s" for name, seconds in future.result().items()})
+    except Exception as e:
+        logger.exception("Model warmup failed: %s", e)
+
 def main():
     print("Starting bot...")
-    app = ApplicationBuilder().token(TOKEN).build()
+    if METRICS_PORT:
+        metrics.start_http_server(int(METRICS_PORT))
+        logger.info("Serving metrics on port %s", METRICS_PORT)
+    # Load the LLM and both encoders in parallel while the bot connects to Telegram
+    models.warmup(background=True).add_done_callback(_log_warmup)
+    app = ApplicationBuilder().token(TOKEN).concurrent_updates(True).build()
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
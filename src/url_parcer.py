@@ -1,29 +1,45 @@
-import time
-import requests
+import os
+import asyncio
+import contextlib
+import numpy as np
 
+from typing import Iterator
+from functools import lru_cache
 from urllib.parse import urlparse, parse_qs
 from bs4 import BeautifulSoup
 from markdownify import markdownify as md 
 
-from memory_profiler import profile
-from langchain.text_splitter import RecursiveCharacterTextSplitter, CharacterTextSplitter
-from langchain.text_splitter import Language
+import inference
+import metrics
+from documents import Document
+from content_extract import HAS_LXML, UnsupportedContent, extract_markdown, extract_pdf_text
+from fetcher import AsyncFetcher, get_fetcher, run_sync
+from page_cache import PageCache, CacheEntry, DEFAULT_TTL, normalize_url
+from domain_health import domain_health, CircuitOpen, URL_STATUSES
+from utils import cache_path
 
-from models import cross_encoder
+# Set PAGE_CACHE_PATH to an empty string to disable the page cache
+PAGE_CACHE_PATH = os.getenv("PAGE_CACHE_PATH", cache_path("pages.sqlite3"))
+page_cache = PageCache(PAGE_CACHE_PATH, ttl=float(os.getenv("PAGE_CACHE_TTL", DEFAULT_TTL))) if PAGE_CACHE_PATH else None
 
-def parse_url(url: str) -> str:
+def html_to_markdown(html_content: str | bytes, encoding: str | None = None) -> str:
     """
-    Parses a URL and returns the HTML content in markdown format.
+    Converts the main content of an HTML page to markdown.
+    Uses the lxml-based extractor, which drops navigation, footers and other boilerplate;
+    falls back to BeautifulSoup + markdownify over the whole body if lxml is not installed.
     
-    :param url (str): The URL to parse.
+    :param html_content (str | bytes): Raw HTML of the page.
+    :param encoding (str): Charset of html_content if it is bytes, detected from the page if None.
     :return str: A markdown representation of the HTML content.
     """
     
-    response = requests.get(url)
-    if response.status_code != 200:
-        raise Exception(f"Failed to retrieve content from {url}. Status code: {response.status_code}")
+    if HAS_LXML:
+        if isinstance(html_content, str):
+            html_content, encoding = html_content.encode("utf-8"), "utf-8"
+        return extract_markdown(html_content, encoding)
     
-    html_content = response.text
+    if isinstance(html_content, bytes):
+        html_content = html_content.decode(encoding or "utf-8", errors="replace")
     soup = BeautifulSoup(html_content, 'html.parser')
     main_content = str(soup.body)
     
@@ -31,44 +47,336 @@ def parse_url(url: str) -> str:
     
     return markdown_content
 
-def extract_relevant(query: str, text: str, min_per_chunk: int = 1024, max_document_length: int=7500) -> str:
+_inflight = {}
+
+async def parse_url_async(url: str, fetcher: AsyncFetcher | None = None,
+                          limit: contextlib.AbstractAsyncContextManager | None = None) -> str:
     """
-    Extracts relevant information from the text using 8-layered BERT
+    Downloads a URL with the shared async fetcher and returns the HTML content in markdown format.
+    Goes through the page cache: fresh pages and recent failures are served from it,
+    expired pages are revalidated with a conditional request. Concurrent calls for the same URL
+    on one event loop share a single download, even if they come from different queries.
     
-    :param query (str): The query to search for in the text.
-    :param text (str): The text to extract information from.
-    :param min_per_chunk (int): The minimum number of characters per chunk.
-    :param max_document_length (int): The maximum length of the document.
+    :param url (str): The URL to parse.
+    :param fetcher (AsyncFetcher): Fetcher to use, the event loop's shared one by default.
+    :param limit (AbstractAsyncContextManager): Shared download limit (e.g. an asyncio.Semaphore), held by the
+        download itself, so a download that keeps running for other callers keeps its slot too.
+    :return str: A markdown representation of the HTML content.
+    """
     
-    :return str: The extracted information.
+    key = normalize_url(url)
+    task = _inflight.get(key)
+    if task is None or task.get_loop() is not asyncio.get_running_loop():
+        task = asyncio.ensure_future(_parse_url(url, fetcher, limit))
+        _inflight[key] = task
+        task.add_done_callback(lambda done: _forget_inflight(key, done))
+    # Shielded: a caller that gives up (e.g. its fetch budget ran out) does not cancel the download for the others
+    return await asyncio.shield(task)
+
+def _forget_inflight(key: str, task: asyncio.Task):
+    if _inflight.get(key) is task:
+        del _inflight[key]
+    if not task.cancelled():
+        # Marks the error as retrieved when every caller has already given up
+        task.exception()
+
+async def _parse_url(url: str, fetcher: AsyncFetcher | None,
+                     limit: contextlib.AbstractAsyncContextManager | None = None) -> str:
+    # The page cache blocks on SQLite, so it is used from a thread
+    entry = await asyncio.to_thread(page_cache.get, url) if page_cache else None
+    if entry is not None and entry.is_fresh():
+        metrics.cache_hit("page")
+        if entry.is_negative:
+            raise Exception(entry.error)
+        return entry.markdown
+    metrics.cache_miss("page")
+    # An expired page is still served if its revalidation fails (stale-if-error)
+    stale = entry if entry is not None and not entry.is_negative else None
+    
+    if domain_health is not None and not domain_health.allow(url):
+        metrics.fetch_failure("circuit_open")
+        if stale is not None:
+            return _serve_stale(stale)
+        raise CircuitOpen(f"Not fetching {url}: its domain keeps failing")
+    
+    validators = stale.validators() if stale is not None else None
+    fetcher = fetcher or get_fetcher()
+    try:
+        async with limit or contextlib.nullcontext():
+            with metrics.span("fetch"):
+                response = await fetcher.fetch(url, headers=validators)
+    except UnsupportedContent as e:
+        # Says nothing about the domain's health; the URL no longer serves a page, so the stale copy is dropped too
+        metrics.fetch_failure("UnsupportedContent")
+        if page_cache:
+            await asyncio.to_thread(page_cache.put_negative, url, f"Failed to retrieve content from {url}: {e!r}")
+        raise
+    except Exception as e:
+        metrics.fetch_failure(type(e).__name__)
+        if domain_health is not None:
+            domain_health.record_failure(url, getattr(e, "elapsed", None))
+        if stale is not None:
+            return _serve_stale(stale)
+        if page_cache:
+            await asyncio.to_thread(page_cache.put_negative, url, f"Failed to retrieve content from {url}: {e!r}")
+        raise
+    
+    if response.status_code == 304 and validators:
+        metrics.cache_hit("page_revalidated")
+        if domain_health is not None:
+            domain_health.record_success(url, response.elapsed, len(entry.markdown))
+        await asyncio.to_thread(page_cache.revalidated, url)
+        return entry.markdown
+    if response.status_code != 200:
+        error = f"Failed to retrieve content from {url}. Status code: {response.status_code}"
+        metrics.fetch_failure(f"http_{response.status_code}")
+        if domain_health is not None and response.status_code not in URL_STATUSES:
+            domain_health.record_failure(url, response.elapsed)
+        # A page that is gone is forgotten; on other errors the stale copy is served and kept
+        if stale is not None and response.status_code not in URL_STATUSES:
+            return _serve_stale(stale)
+        if page_cache:
+            await asyncio.to_thread(page_cache.put_negative, url, error, response.status_code)
+        raise Exception(error)
+    
+    with metrics.span("extract", kind=response.kind):
+        if response.kind == "pdf":
+            try:
+                markdown_content = await asyncio.to_thread(extract_pdf_text, response.content)
+            except UnsupportedContent as e:
+                metrics.fetch_failure("UnsupportedContent")
+                if page_cache:
+                    await asyncio.to_thread(page_cache.put_negative, url, str(e))
+                raise
+        else:
+            markdown_content = await asyncio.to_thread(html_to_markdown, response.content, response.encoding)
+    if domain_health is not None:
+        domain_health.record_success(url, response.elapsed, len(markdown_content))
+    if page_cache:
+        await asyncio.to_thread(page_cache.put, url, markdown_content,
+                                etag=response.headers.get("ETag"),
+                                last_modified=response.headers.get("Last-Modified"))
+    return markdown_content
+
+def _serve_stale(entry: CacheEntry) -> str:
+    metrics.cache_hit("page_stale")
+    return entry.markdown
+
+async def _parse_or_error(url: str, fetcher: AsyncFetcher | None) -> tuple[str, str | Exception]:
+    try:
+        return url, await parse_url_async(url, fetcher)
+    except Exception as e:
+        return url, e
+
+async def parse_urls(urls: list[str], fetcher: AsyncFetcher | None = None):
+    """
+    Downloads several URLs concurrently and yields their markdown as soon as each page is ready.
+    
+    :param urls (list[str]): The URLs to parse.
+    :param fetcher (AsyncFetcher): Fetcher to use, the event loop's shared one by default.
+    :return: Async iterator of (url, markdown) tuples; a failed URL yields its Exception instead of markdown.
+    """
+    
+    tasks = [asyncio.ensure_future(_parse_or_error(url, fetcher)) for url in urls]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def parse_url(url: str) -> str:
+    """
+    Parses a URL and returns the HTML content in markdown format.
+    Synchronous wrapper around parse_url_async.
+    
+    :param url (str): The URL to parse.
+    :return str: A markdown representation of the HTML content.
+    """
+    
+    return run_sync(parse_url_async(url))
+
+# Chunks per page passed on to the cross-encoder; generous, since the TF-IDF stage only drops clear misses
+LEXICAL_TOP_K = 24
+
+class CascadeReport:
+    """
+    Counts how many (query, chunk) pairs the lexical stage kept away from the cross-encoder during one request.
     """
     
-    splitter = RecursiveCharacterTextSplitter.from_language(
+    def __init__(self):
+        self.pages = 0
+        self.candidates = 0
+        self.scored = 0
+    
+    @property
+    def saved(self) -> int:
+        return self.candidates - self.scored
+    
+    def as_dict(self) -> dict:
+        return {
+            "pages": self.pages,
+            "candidate_pairs": self.candidates,
+            "cross_encoder_pairs": self.scored,
+            "cross_encoder_pairs_saved": self.saved,
+            "saved_ratio": round(self.saved / self.candidates, 3) if self.candidates else 0.0,
+        }
+
+@lru_cache(maxsize=8)
+def _get_splitter(min_per_chunk: int, chunk_overlap: int):
+    # Imported here: langchain is slow to import and only needed once chunking starts
+    from langchain.text_splitter import RecursiveCharacterTextSplitter, Language
+    
+    return RecursiveCharacterTextSplitter.from_language(
     language=Language.MARKDOWN,
     chunk_size=min_per_chunk,
-    chunk_overlap=min_per_chunk//2
+    chunk_overlap=chunk_overlap
     )
+
+def split_chunks(text: str, min_per_chunk: int = 1024, chunk_overlap: int | None = None) -> list[str]:
+    """
+    Splits markdown text into overlapping chunks.
+    
+    :param text (str): The text to split.
+    :param min_per_chunk (int): The minimum number of characters per chunk.
+    :param chunk_overlap (int): Characters shared by neighbouring chunks, half a chunk by default.
+    :return list[str]: The chunks in document order.
+    """
+    
+    if chunk_overlap is None:
+        chunk_overlap = min_per_chunk // 2
+    return _get_splitter(min_per_chunk, chunk_overlap).split_text(text)
+
+def lexical_prefilter(query: str, chunks: list[str], top_k: int | None = LEXICAL_TOP_K) -> list[int]:
+    """
+    Cheap first stage of the chunk cascade: ranks the chunks of one page by TF-IDF cosine similarity
+    to the query, computed with sparse matrix operations, and keeps the top_k. Terms are character
+    3-5-grams within words, so inflected forms (e.g. "курс" and "курса") still match.
     
-    chunks = splitter.split_text(text)
+    :param query (str): The query.
+    :param chunks (list[str]): Chunks of one page.
+    :param top_k (int): Number of chunks to keep; None keeps all.
+    :return list[int]: Indices of the kept chunks in document order.
+    """
+    
+    if top_k is None or len(chunks) <= top_k:
+        return list(range(len(chunks)))
+    
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    
+    vectorizer = TfidfVectorizer(sublinear_tf=True, analyzer="char_wb", ngram_range=(3, 5))
+    try:
+        chunk_matrix = vectorizer.fit_transform(chunks)
+    except ValueError:
+        # No text at all: keep the first chunks
+        return list(range(top_k))
+    scores = (chunk_matrix @ vectorizer.transform([query]).T).toarray().ravel()
+    return sorted(np.argsort(-scores, kind="stable")[:top_k].tolist())
+
+def extract_relevant_many(query: str | list[str] | dict[str, str | list[str]], texts: dict[str, str], min_per_chunk: int = 1024,
+                          max_document_length: int = 7500, chunk_overlap: int | None = None,
+                          lexical_top_k: int | None = LEXICAL_TOP_K, report: CascadeReport | None = None) -> dict[str, str]:
+    """
+    Extracts relevant information from several documents at once.
+    
+    Chunks go through a two-stage cascade: a TF-IDF pre-filter keeps the lexical_top_k best chunks of each page,
+    and only those are scored by the cross-encoder. The (query, chunk) pairs of all documents are sent to the
+    inference service in one call, where they are scored in large length-sorted batches together with other
+    requests, and the scores are split back per document. With several queries (e.g. the focus queries of
+    ParaphaseMode.EXPAND) a chunk is scored against each of them and keeps its best score.
+    
+    :param query (str | list[str] | dict): The query (or queries) to search for, or a mapping from document key to its own query or queries.
+    :param texts (dict[str, str]): Mapping from document key (usually the URL) to its text.
+    :param min_per_chunk (int): The minimum number of characters per chunk.
+    :param max_document_length (int): The maximum length of each extracted document.
+    :param chunk_overlap (int): Characters shared by neighbouring chunks, half a chunk by default.
+    :param lexical_top_k (int): Chunks per page passed to the cross-encoder; None disables the lexical stage.
+    :param report (CascadeReport): If given, updated with the number of candidate and cross-encoder pairs.
     
-    def batched_predict(pairs, batch_size=8):
-        results = []
-        for i in range(0, len(pairs), batch_size):
-            batch = pairs[i:i+batch_size]
-            results.extend(cross_encoder.predict(batch))
-        return results
+    :return dict[str, str]: The extracted information for every document key.
+    """
     
-    pairs = [(query, chunk) for chunk in chunks]
-    scores = batched_predict(pairs)
-    ranked = sorted(zip(scores, chunks), key=lambda x: x[0], reverse=True)
+    scored = _score_chunks(query, texts, min_per_chunk, chunk_overlap, lexical_top_k, report)
+    return {key: "\n\n".join(_select_chunks(doc_scored, max_document_length)[0]) for key, doc_scored in scored.items()}
+
+def extract_documents(query: str | list[str], texts: dict[str, str], ids: Iterator[int], min_per_chunk: int = 1024,
+                      max_document_length: int = 7500, chunk_overlap: int | None = None,
+                      lexical_top_k: int | None = LEXICAL_TOP_K, report: CascadeReport | None = None) -> list[Document]:
+    """
+    Same as extract_relevant_many, but returns Document records that keep the scores of the selected chunks.
+    Pages with nothing relevant are left out.
+    
+    :param query (str | list[str]): The query or queries to search for.
+    :param texts (dict[str, str]): Mapping from URL to page text.
+    :param ids (Iterator[int]): Source of document ids, shared by all batches of a run.
+    :return list[Document]: One document per page with relevant chunks, in the order of texts.
+    """
+    
+    documents = []
+    for url, doc_scored in _score_chunks(query, texts, min_per_chunk, chunk_overlap, lexical_top_k, report).items():
+        chunks, scores = _select_chunks(doc_scored, max_document_length)
+        if chunks:
+            documents.append(Document(next(ids), url, "\n\n".join(chunks), np.asarray(scores, dtype=np.float32)))
+    return documents
+
+def _score_chunks(query, texts, min_per_chunk, chunk_overlap, lexical_top_k, report) -> dict:
+    owners = []
+    pairs = []
+    for key, text in texts.items():
+        doc_queries = query[key] if isinstance(query, dict) else query
+        if isinstance(doc_queries, str):
+            doc_queries = [doc_queries]
+        chunks = split_chunks(text, min_per_chunk, chunk_overlap)
+        kept = lexical_prefilter(" ".join(doc_queries), chunks, lexical_top_k)
+        if report is not None:
+            report.pages += 1
+            report.candidates += len(chunks) * len(doc_queries)
+            report.scored += len(kept) * len(doc_queries)
+        for i in kept:
+            for doc_query in doc_queries:
+                owners.append((key, i))
+                pairs.append((doc_query, chunks[i]))
+    
+    with metrics.span("chunk_scoring"):
+        scores = inference.service.predict(pairs)
+    
+    best = {}
+    for owner, (_, chunk), score in zip(owners, pairs, scores):
+        if owner not in best or score > best[owner][0]:
+            best[owner] = (score, chunk)
+    
+    scored = {key: [] for key in texts}
+    for (key, _), score_and_chunk in best.items():
+        scored[key].append(score_and_chunk)
+    
+    return scored
+
+def _select_chunks(scored: list[tuple[float, str]], max_document_length: int) -> tuple[list[str], list[float]]:
+    ranked = sorted(scored, key=lambda x: x[0], reverse=True)
     relevant_chunks = []
+    scores = []
     length = 0
     for score, chunk in ranked:
         if length + len(chunk) > max_document_length:
             break
         relevant_chunks.append(chunk)
+        scores.append(score)
         length += len(chunk)
-    return "\n\n".join(relevant_chunks)
+    return relevant_chunks, scores
+
+def extract_relevant(query: str, text: str, min_per_chunk: int = 1024, max_document_length: int=7500) -> str:
+    """
+    Extracts relevant information from the text using 8-layered BERT
+    
+    :param query (str): The query to search for in the text.
+    :param text (str): The text to extract information from.
+    :param min_per_chunk (int): The minimum number of characters per chunk.
+    :param max_document_length (int): The maximum length of the document.
+    
+    :return str: The extracted information.
+    """
+    
+    return extract_relevant_many(query, {None: text}, min_per_chunk, max_document_length)[None]
 
 if __name__ == "__main__":
     url = "https://en.wikipedia.org/wiki/Artificial_intelligence"
@@ -1,3 +1,11 @@
+import os
+
+CACHE_DIR = os.getenv("AIDS_CACHE_DIR", os.path.expanduser("~/.cache/aidrivensearch"))
+
+def cache_path(*parts):
+    """Path inside the application's cache directory."""
+    return os.path.join(CACHE_DIR, *parts)
+
 def print_documents(docs):
     for i, doc in enumerate(docs, 1):
         print(f"[{i}] {doc['title']}\n{doc['snippet']}\n{doc['link']}\n")
\ No newline at end of file
@@ -1,5 +1,8 @@
+import os
 import time
+import threading
 import requests
+import requests.adapters
 
 import urllib.parse
 import yaml
@@ -8,10 +11,82 @@ from xml.etree import ElementTree as ET
 from abc import ABC, abstractmethod
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import metrics
+
+from caching import LRUCache
+
 
 DEFAULT_NUM_RESULTS = 10
+DEFAULT_TIMEOUT = (3.05, 10)
+# Rank offset of reciprocal-rank fusion; 60 is the value from the original RRF paper
+RRF_K = 60
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", 6 * 3600))
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", 10_000))
+
+# Overridable so benchmarks can point the engines at a local fake server
+YANDEX_SEARCH_URL = os.getenv("YANDEX_SEARCH_URL", "https://yandex.ru/search/xml")
+GOOGLE_SEARCH_URL = os.getenv("GOOGLE_SEARCH_URL", "https://www.googleapis.com/customsearch/v1")
+YANDEX_CONFIG_PATH = os.getenv("YANDEX_CONFIG_PATH", "api_key.yaml")
+GOOGLE_CONFIG_PATH = os.getenv("GOOGLE_CONFIG_PATH", "api_key_google.yaml")
+
+search_cache = LRUCache(SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL)
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class Quota:
+    """
+    Fixed-window call quota: at most ``limit`` calls per ``period`` seconds (unlimited if limit is None).
+    """
+
+    def __init__(self, limit: int | None = None, period: float = 24 * 3600):
+        self.limit = limit
+        self.period = period
+        self.used = 0
+        self._window_start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            if now - self._window_start >= self.period:
+                self._window_start = now
+                self.used = 0
+            if self.limit is not None and self.used >= self.limit:
+                return False
+            self.used += 1
+            return True
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.lower().split())
+
 
 class SearchEngine(ABC):
+    name = "engine"
+
+    def __init__(self, quota: Quota | None = None, cache: LRUCache | None = search_cache, timeout=DEFAULT_TIMEOUT):
+        self.quota = quota or Quota()
+        self.cache = cache
+        self.timeout = timeout
+        self.stats = {"api_calls": 0, "cache_hits": 0, "quota_rejections": 0, "errors": 0}
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self) -> requests.Session:
+        """HTTP session with a connection pool, shared by all searches of this engine."""
+        with self._session_lock:
+            if self._session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._session = session
+        return self._session
+
     @abstractmethod
     def build_url(self, query: str, **kwargs) -> tuple[str, dict]:
         pass
@@ -21,16 +96,42 @@ class SearchEngine(ABC):
         pass
 
     def search(self, query: str, **kwargs) -> list[dict]:
+        key = (self.name, normalize_query(query), tuple(sorted(kwargs.items())))
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.stats["cache_hits"] += 1
+                metrics.cache_hit("search")
+                return list(cached)
+            metrics.cache_miss("search")
+
+        if not self.quota.acquire():
+            self.stats["quota_rejections"] += 1
+            raise QuotaExceeded(f"Квота запросов к {self.name} исчерпана")
+
         base_url, params = self.build_url(query, **kwargs)
-        response = requests.get(base_url, params=params)
+        self.stats["api_calls"] += 1
+        try:
+            with metrics.span("search", engine=self.name):
+                response = self.session.get(base_url, params=params, timeout=self.timeout)
+        except requests.RequestException:
+            self.stats["errors"] += 1
+            raise
         if response.status_code != 200:
+            self.stats["errors"] += 1
             raise Exception(f"Ошибка при выполнении запроса: {response.status_code}")
 
-        return self.parse_response(response)
+        results = self.parse_response(response)
+        if self.cache is not None:
+            self.cache.put(key, results)
+        return list(results)
 
 
 class YandexSearch(SearchEngine):
-    def __init__(self, api_key: str, folder_id: str):
+    name = "Yandex"
+
+    def __init__(self, api_key: str, folder_id: str, **kwargs):
+        super().__init__(**kwargs)
         self.api_key = api_key
         self.folder_id = folder_id
 
@@ -39,7 +140,7 @@ class YandexSearch(SearchEngine):
         num_results = kwargs.get("num_results", DEFAULT_NUM_RESULTS)
         groupby_param = f"attr=d.mode=flat.groups-on-page={num_results}"
         
-        base_url = 'https://yandex.ru/search/xml'
+        base_url = YANDEX_SEARCH_URL
         params = {
             'folderid': self.folder_id,
             'apikey': self.api_key,
@@ -75,12 +176,15 @@ class YandexSearch(SearchEngine):
 
 
 class GoogleSearch(SearchEngine):
-    def __init__(self, api_key: str, cse_id: str):
+    name = "Google"
+
+    def __init__(self, api_key: str, cse_id: str, **kwargs):
+        super().__init__(**kwargs)
         self.api_key = api_key
         self.cse_id = cse_id
 
     def build_url(self, query: str, **kwargs) -> tuple[str, dict]:
-        base_url = 'https://www.googleapis.com/customsearch/v1'
+        base_url = GOOGLE_SEARCH_URL
         params = {
             'key': self.api_key,
             'cx': self.cse_id,
@@ -119,51 +223,95 @@ class WebSearcher:
         return results[:num_results] if results else None
 
 
-def load_yandex_config(path="api_key.yaml"):
+def load_yandex_config(path=YANDEX_CONFIG_PATH):
     with open(path, "r") as f:
         config = yaml.safe_load(f)
     return config["folder_id"], config["secret"]
 
 
-def load_google_config(path="api_key_google.yaml"):
+def load_google_config(path=GOOGLE_CONFIG_PATH):
     with open(path, "r") as f:
         config = yaml.safe_load(f)
     return config["cse_id"], config["secret"]
 
-cse, api_key_google = load_google_config()
-folder_id, api_key_yandex = load_yandex_config()
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="web-search")
+_searchers = None
+_searchers_lock = threading.Lock()
 
-def parallel_search(searchers, query, num_results):
+
+def _quota_from_env(name: str) -> Quota:
+    limit = os.getenv(f"{name.upper()}_DAILY_QUOTA")
+    return Quota(int(limit) if limit else None)
+
+
+def get_searchers() -> dict[str, WebSearcher]:
+    """
+    Returns the long-lived Google and Yandex searchers, creating them on first use.
+    API keys are read from the config files at that point, not at import time.
+    """
+
+    global _searchers
+    with _searchers_lock:
+        if _searchers is None:
+            cse, api_key_google = load_google_config()
+            folder_id, api_key_yandex = load_yandex_config()
+            _searchers = {
+                "Google": WebSearcher(GoogleSearch(api_key=api_key_google, cse_id=cse, quota=_quota_from_env("Google"))),
+                "Yandex": WebSearcher(YandexSearch(api_key=api_key_yandex, folder_id=folder_id, quota=_quota_from_env("Yandex"))),
+            }
+    return _searchers
+
+
+def search_stats() -> dict:
+    """Per-engine API call, cache hit, quota and error counters, and the state of the shared result cache."""
+    stats = {name: dict(searcher.engine.stats) for name, searcher in get_searchers().items()}
+    stats["cache"] = search_cache.stats()
+    return stats
+
+
+def reciprocal_rank_fusion(rankings: list[list[str]], k: int = RRF_K) -> dict[str, float]:
+    """
+    Fuses several rankings of URLs: every URL gets the sum of 1 / (k + rank) over the rankings it appears in.
+
+    :param rankings: URL lists, best first; repeated URLs within one list count once.
+    :param k: Rank offset; larger values flatten the difference between top and lower ranks.
+    :return: Fused score of every URL, sorted from best to worst.
+    """
+
+    scores = {}
+    for ranking in rankings:
+        seen = set()
+        for rank, url in enumerate(ranking, start=1):
+            if url in seen:
+                continue
+            seen.add(url)
+            scores[url] = scores.get(url, 0.0) + 1 / (k + rank)
+    return dict(sorted(scores.items(), key=lambda item: item[1], reverse=True))
+
+
+def parallel_search(searchers, query, num_results, executor=None):
     results = {}
-    with ThreadPoolExecutor(max_workers=len(searchers)) as executor:
-        future_to_engine = {
-            executor.submit(searcher.search, query, num_results): name
-            for name, searcher in searchers.items()
-        }
+    executor = executor or _executor
+    future_to_engine = {
+        executor.submit(searcher.search, query, num_results): name
+        for name, searcher in searchers.items()
+    }
 
-        for future in as_completed(future_to_engine):
-            engine_name = future_to_engine[future]
-            try:
-                results[engine_name] = future.result()
-            except Exception as e:
-                results[engine_name] = f"Ошибка: {e}"
+    for future in as_completed(future_to_engine):
+        engine_name = future_to_engine[future]
+        try:
+            results[engine_name] = future.result()
+        except Exception as e:
+            results[engine_name] = f"Ошибка: {e}"
 
     return results
 
 
 def parallel_search_yandex_google(query : str, num_results : int = 5, unbox_unique : bool = True) -> list[dict[str]] | dict[list[dict[str]]] | None:
-    google_engine = GoogleSearch(api_key=api_key_google, cse_id=cse)
-    yandex_engine = YandexSearch(api_key=api_key_yandex, folder_id=folder_id)
-    
-    searchers = {
-        "Google": WebSearcher(google_engine),
-        "Yandex": WebSearcher(yandex_engine)
-    }
-    
-    results = parallel_search(searchers, query, num_results=num_results)
+    results = parallel_search(get_searchers(), query, num_results=num_results)
     if unbox_unique:
-        unique_urls = {r["url"] for res in results.values() if isinstance(res, list) for r in res if "url" in r}
-        return list(unique_urls) 
+        rankings = [[r["url"] for r in res if "url" in r] for res in results.values() if isinstance(res, list)]
+        return list(reciprocal_rank_fusion(rankings))
     return results
     
 
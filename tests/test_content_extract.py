@@ -0,0 +1,16 @@
+import pytest
+
+import content_extract
+
+pytestmark = pytest.mark.skipif(not content_extract.HAS_LXML, reason="requires lxml")
+
+
+@pytest.mark.parametrize("content", [b"", b"   \n", b"<!-- x -->", b"<!-- a --> <!-- b -->\n"])
+def test_empty_document(content):
+    assert content_extract.extract_markdown(content) == ""
+
+
+def test_boilerplate_wrapper_of_main_content_is_kept():
+    paragraphs = "".join(f"<p>Paragraph {i} about borscht, beetroot, cabbage and stock.</p>" for i in range(3))
+    html = f'<html><body><div class="wrap header-fixed"><div class="content">{paragraphs}</div></div></body></html>'
+    assert "Paragraph 2 about borscht" in content_extract.extract_markdown(html.encode())
@@ -0,0 +1,23 @@
+import context_packer
+
+from documents import Document
+
+
+def make_document(id: int, passages: int, words: int = 60) -> Document:
+    text = "\n\n".join(" ".join(f"doc{id}passage{j}word{k}" for k in range(words)) for j in range(passages))
+    return Document(id, f"https://example.com/{id}", text)
+
+
+def test_every_document_gets_a_share_of_the_budget():
+    documents = [make_document(i, passages=10) for i in range(5)]
+    packed = context_packer.pack_context(documents, token_budget=4000)
+    assert [document.id for document in packed] == [0, 1, 2, 3, 4]
+    assert sum(context_packer.count_tokens([document.text for document in packed])) <= 4000
+
+
+def test_budget_left_by_short_documents_goes_to_the_others():
+    documents = [make_document(0, passages=10), make_document(1, passages=1, words=5), make_document(2, passages=10)]
+    packed = context_packer.pack_context(documents, token_budget=3000)
+    assert [document.id for document in packed] == [0, 1, 2]
+    assert packed[1].text == documents[1].text
+    assert len(packed[0].text) > len(packed[2].text)
@@ -0,0 +1,24 @@
+import asyncio
+
+import fetcher
+
+
+def test_host_slots_are_limited_and_dropped_when_idle():
+    client = fetcher.AsyncFetcher(per_host_limit=2)
+    active = []
+    peak = []
+
+    async def request(url):
+        async with client._host_slot(url):
+            active.append(url)
+            peak.append(sum(1 for other in active if other.startswith("https://a.example")))
+            await asyncio.sleep(0.01)
+            active.remove(url)
+
+    async def run():
+        await asyncio.gather(*(request(f"https://a.example/{i}") for i in range(5)),
+                             request("https://b.example/"))
+        return dict(client._host_semaphores)
+
+    assert asyncio.run(run()) == {}
+    assert max(peak) == 2
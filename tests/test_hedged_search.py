@@ -0,0 +1,59 @@
+import asyncio
+import threading
+import time
+
+import pipeline
+
+
+class SlowFirstSearcher:
+    """Searcher whose first call hangs, so only a hedged second call can answer in time."""
+
+    class engine:
+        name = "Fake"
+
+    def __init__(self, first_delay: float = 1.0):
+        self.first_delay = first_delay
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def search(self, query, num_results):
+        with self._lock:
+            self.calls += 1
+            first = self.calls == 1
+        time.sleep(self.first_delay if first else 0.01)
+        return [{"url": f"https://example.com/{query}/{'first' if first else 'hedge'}"}]
+
+
+def search_one(pipe, searcher, query="q"):
+    # Timed inside the loop: asyncio.run also waits for the abandoned first call's thread
+    async def run():
+        started = time.perf_counter()
+        result = await pipe._search_one(searcher, query)
+        return result, time.perf_counter() - started
+    return asyncio.run(run())
+
+
+def test_slow_search_is_hedged():
+    searcher = SlowFirstSearcher()
+    pipe = pipeline.RetrievalPipeline(hedge_after=0.05, answer_cache=None)
+    (query, results), elapsed = search_one(pipe, searcher)
+    assert query == "q"
+    assert results == [{"url": "https://example.com/q/hedge"}]
+    assert searcher.calls == 2
+    assert elapsed < searcher.first_delay
+
+
+def test_no_hedge_without_a_free_search_slot():
+    searcher = SlowFirstSearcher(first_delay=0.2)
+    pipe = pipeline.RetrievalPipeline(hedge_after=0.05, search_limit=1, answer_cache=None)
+    (_, results), _ = search_one(pipe, searcher)
+    assert results == [{"url": "https://example.com/q/first"}]
+    assert searcher.calls == 1
+
+
+def test_hedging_disabled():
+    searcher = SlowFirstSearcher(first_delay=0.2)
+    pipe = pipeline.RetrievalPipeline(hedge_after=None, answer_cache=None)
+    (_, results), _ = search_one(pipe, searcher)
+    assert results == [{"url": "https://example.com/q/first"}]
+    assert searcher.calls == 1